@@ -0,0 +1,99 @@
+"""Measure SSH cipher throughput against a local stand-in server."""
+
+import os
+import socket
+import threading
+import time
+
+from typing import List, Optional, Sequence, Tuple
+
+import paramiko
+
+from paramiko.common import AUTH_SUCCESSFUL, OPEN_SUCCEEDED
+
+from .sftp import CHUNK_SIZE, TransportOptions, _configure_transport
+
+
+class _BenchServer(paramiko.ServerInterface):
+    """SSH server that accepts any user without authentication and opens any channel."""
+
+    def get_allowed_auths(self, username: str) -> str:
+        """Only allow "none" authentication."""
+        return "none"
+
+    def check_auth_none(self, username: str) -> int:
+        """Accept all users."""
+        return AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind: str, chanid: int) -> int:
+        """Accept all channels."""
+        return OPEN_SUCCEEDED
+
+
+def _measure(cipher: str, mac: str, host_key: paramiko.PKey, size: int) -> float:
+    """Send `size` bytes through a local SSH connection and return throughput in MiB/s."""
+    client_socket, server_socket = socket.socketpair()
+    server = paramiko.Transport(server_socket)
+    server.add_server_key(host_key)
+    client = paramiko.Transport(client_socket)
+    _configure_transport(client, TransportOptions(ciphers=[cipher], macs=[mac]))
+    try:
+        server.start_server(event=threading.Event(), server=_BenchServer())
+        client.start_client()
+        if client.local_cipher != cipher:
+            raise paramiko.SSHException(f"Negotiated {client.local_cipher} instead.")
+        client.auth_none("bench")
+        channel = client.open_session()
+        server_channel = server.accept(timeout=10)
+        if server_channel is None:
+            raise paramiko.SSHException("Stand-in server did not accept channel.")
+
+        def _drain() -> None:
+            received = 0
+            while received < size:
+                data = server_channel.recv(CHUNK_SIZE)
+                if not data:
+                    break
+                received += len(data)
+
+        reader = threading.Thread(target=_drain, name="bench-reader")
+        payload = os.urandom(min(CHUNK_SIZE, size))
+        start = time.perf_counter()
+        reader.start()
+        sent = 0
+        while sent < size:
+            chunk = payload[: size - sent]
+            channel.sendall(chunk)
+            sent += len(chunk)
+        reader.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        client.close()
+        server.close()
+    return size / elapsed / 1_048_576
+
+
+def bench_ciphers(size: int = 64 * 1_048_576, ciphers: Optional[Sequence[str]] = None, mac: str = "") -> List[Tuple[str, str, float]]:
+    """Measure throughput of each cipher, fastest first.
+
+    Returns a list of `(cipher, mac, MiB/s)` tuples. If `ciphers` is not given,
+    every cipher supported by paramiko is measured. If `mac` is not given, the
+    paramiko default MAC is used.
+    """
+    transport = paramiko.Transport(socket.socket())
+    security_options = transport.get_security_options()
+    ciphers = ciphers or security_options.ciphers
+    mac = mac or security_options.digests[0]
+    transport.close()
+    print("Generating host key for stand-in server.")
+    host_key = paramiko.RSAKey.generate(2048)
+    results = []
+    for cipher in ciphers:
+        try:
+            throughput = _measure(cipher, mac, host_key, size)
+        except Exception as e:
+            print(f"Benchmark of {cipher} failed: {e}")
+            continue
+        print(f"{cipher:<24} {mac:<32} {throughput:8.1f} MiB/s")
+        results.append((cipher, mac, throughput))
+    return sorted(results, key=lambda result: result[2], reverse=True)
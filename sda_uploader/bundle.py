@@ -0,0 +1,277 @@
+"""Upload a directory as streamed Crypt4GH encrypted tar archives."""
+
+import io
+import os
+import json
+import hashlib
+import tarfile
+import threading
+
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import paramiko
+
+from crypt4gh.lib import encrypt
+
+from .encrypt import _FullReader
+from .sftp import CHUNK_SIZE, _get_remote_size, _progress
+from .trace import span
+from .walk import WalkRules, walk_tree
+
+# (local path, name in archive, size, modification time in nanoseconds)
+_Member = Tuple[str, str, int, int]
+
+
+def _member_digest(digest: "hashlib._Hash", member: _Member) -> None:
+    """Add name, size and modification time of a member to the digest identifying an archive."""
+    _, arcname, size, mtime = member
+    digest.update(f"{arcname}\0{size}\0{mtime}\n".encode())
+
+
+class _RemoteWriter:
+    """Write encrypted stream to remote file in chunks of `CHUNK_SIZE`.
+
+    Crypt4GH silently stops encrypting when writing the output raises `IOError`,
+    so the first error is kept in `error` to be raised after encryption.
+    """
+
+    def __init__(self, remote_file: paramiko.SFTPFile, filename: str = "", client: str = "") -> None:
+        """Initialise writer."""
+        self.remote_file = remote_file
+        self.filename = filename
+        self.client = client
+        self.remote_size = 0
+        self.buffer = bytearray()
+        self.error: Optional[Exception] = None
+
+    def write(self, data: bytes) -> None:
+        """Buffer data, and write it when a chunk is full."""
+        self.buffer += data
+        if len(self.buffer) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write buffered data to remote file."""
+        if self.error is not None:
+            raise self.error
+        if not self.buffer:
+            return
+        try:
+            with span("write", file=self.filename, size=len(self.buffer)):
+                self.remote_file.write(bytes(self.buffer))
+            with span("flush", file=self.filename):
+                self.remote_file.flush()
+        except Exception as e:
+            self.error = e
+            raise
+        self.remote_size += len(self.buffer)
+        self.buffer.clear()
+        # the size of the encrypted archive is not known beforehand, so only the uploaded size is shown
+        _progress(filename=self.filename, remote_size=self.remote_size, local_size=self.remote_size, client=self.client)
+
+
+class _BundleWalk:
+    """Walk a directory, handing out its entries to consecutive bundles of at most `bundle_size` bytes of files.
+
+    A bundle's members are first walked ahead to find where the bundle ends and to compute its digest, which
+    identifies the archive when resuming. The members are then walked again as they are streamed to the archive,
+    so memory use doesn't grow with the number of files.
+    """
+
+    def __init__(self, directory: str, rules: Optional[WalkRules] = None, bundle_size: Optional[int] = None) -> None:
+        """Start walking directory."""
+        self.root = Path(directory).name
+        self.ahead = self._members(directory, rules)
+        self.stream = self._members(directory, rules)
+        self.bundle_size = bundle_size
+        self.next_member = next(self.ahead, None)
+
+    def _members(self, directory: str, rules: Optional[WalkRules]) -> Iterator[_Member]:
+        """Walk directory as archive members."""
+        for entry, relative_path in walk_tree(directory, rules):
+            is_dir = entry.is_dir(follow_symlinks=False)
+            stat = entry.stat(follow_symlinks=False)
+            # directory times change with their contents, which are identified by the members themselves
+            yield (entry.path, f"{self.root}/{relative_path}", 0 if is_dir else stat.st_size, 0 if is_dir else stat.st_mtime_ns)
+
+    def next_bundle(self) -> Optional[Tuple[int, str]]:
+        """Walk ahead over the next bundle, and return its number of members and digest, or None when the walk is done.
+
+        A file larger than `bundle_size` is put in a bundle of its own.
+        """
+        if self.next_member is None:
+            return None
+        count = 0
+        size = 0
+        digest = hashlib.sha256()
+        while self.next_member is not None:
+            member = self.next_member
+            if self.bundle_size is not None and count and size + member[2] > self.bundle_size:
+                break
+            _member_digest(digest, member)
+            count += 1
+            size += member[2]
+            self.next_member = next(self.ahead, None)
+        return count, digest.hexdigest()
+
+    def members(self, count: int) -> Iterator[_Member]:
+        """Return the next `count` members for streaming to an archive."""
+        return islice(self.stream, count)
+
+
+class _TarWriter:
+    """Write members as a tar stream to a file descriptor on its own thread.
+
+    Offsets of files in the stream are recorded to `index`, the size of the whole stream to `size`,
+    and the digest of the members actually written to `digest`.
+    """
+
+    def __init__(self, members: Iterator[_Member], write_fd: int) -> None:
+        """Initialise writer."""
+        self.members = members
+        self.write_fd = write_fd
+        self.index: List[Dict[str, Union[str, int]]] = []
+        self.errors: List[Exception] = []
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+    def write(self, data: bytes) -> None:
+        """Write tar data to the pipe."""
+        self.stream.write(data)
+        self.size += len(data)
+
+    def run(self) -> None:
+        """Write the tar stream."""
+        try:
+            with os.fdopen(self.write_fd, "wb") as self.stream:
+                with tarfile.open(fileobj=self, mode="w|") as tar:  # type: ignore
+                    for member in self.members:
+                        _member_digest(self.digest, member)
+                        path, arcname, _, _ = member
+                        info = tar.gettarinfo(path, arcname)
+                        header_offset = tar.offset
+                        if not info.isreg():
+                            tar.addfile(info)
+                            continue
+                        with open(path, "rb") as f:
+                            tar.addfile(info, f)
+                        # file data is padded to full blocks after the header
+                        data_blocks = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                        self.index.append({"name": arcname, "offset": header_offset, "offset_data": tar.offset - data_blocks, "size": info.size})
+        except Exception as e:
+            self.errors.append(e)
+
+
+def _encrypt_bytes(data: bytes, private_key: Union[bytes, Path] = b"", public_key: Union[str, Path] = "") -> bytes:
+    """Encrypt bytes in memory with Crypt4GH."""
+    encrypted = io.BytesIO()
+    reader = _FullReader(io.BytesIO(data))
+    encrypt([(0, private_key, public_key)], reader, encrypted)
+    if reader.size != len(data):
+        raise Exception(f"Encrypted {reader.size} of {len(data)} bytes.")
+    return encrypted.getvalue()
+
+
+def _remote_digest(sftp: paramiko.SFTPClient, destination: str) -> str:
+    """Read the digest of members of an uploaded archive, or return empty string if there's none."""
+    try:
+        with sftp.open(f"{destination}.members.sha256", "r") as remote_file:
+            return remote_file.read().decode().strip()
+    except IOError:
+        return ""
+
+
+def _upload_bundle(
+    sftp: paramiko.SFTPClient,
+    members: Iterator[_Member],
+    destination: str,
+    digest: str,
+    private_key: Union[bytes, Path] = b"",
+    public_key: Union[str, Path] = "",
+    overwrite: bool = False,
+    client: str = "",
+) -> None:
+    """Stream members as an encrypted tar archive to `destination`, with an encrypted index of file offsets next to it.
+
+    The archive is written to a `.part` file that is renamed when complete, and the `digest` of its members
+    is then written next to it in plain text. An archive is skipped when resuming only if its digest matches,
+    so an archive is uploaded again if the files that belong to it have changed.
+    """
+    if not overwrite and _get_remote_size(sftp, destination) > 0 and _remote_digest(sftp, destination) == digest:
+        print(f"Skipping {destination}, it has already been uploaded")
+        # the members still have to be walked past, so that the next bundle starts at the right entry
+        for _ in members:
+            pass
+        return
+    partial = f"{destination}.part"
+    read_fd, write_fd = os.pipe()
+    tar_writer = _TarWriter(members, write_fd)
+    writer = threading.Thread(target=tar_writer.run, name="bundle-tar", daemon=True)
+    print(f"Uploading {destination}")
+    writer.start()
+    try:
+        # closing the read end on failure stops the tar writer with a broken pipe
+        with os.fdopen(read_fd, "rb") as stream:
+            with sftp.open(partial, "wb") as remote_file:
+                output = _RemoteWriter(remote_file, filename=destination, client=client)
+                reader = _FullReader(stream)
+                with span("encrypt_bundle", file=destination):
+                    encrypt([(0, private_key, public_key)], reader, output)
+                output.flush()
+    finally:
+        writer.join()
+    if tar_writer.errors:
+        raise tar_writer.errors[0]
+    # an incomplete archive must not be renamed, as complete archives are not uploaded again
+    if reader.size != tar_writer.size:
+        raise Exception(f"Archive {destination} was not encrypted completely, encrypted {reader.size} of {tar_writer.size} bytes.")
+    if tar_writer.digest.hexdigest() != digest:
+        raise Exception(f"Files changed while {destination} was uploaded, upload the directory again.")
+    with span("upload_index", file=destination):
+        with sftp.open(f"{destination}.index.json.c4gh", "wb") as remote_file:
+            remote_file.write(_encrypt_bytes(json.dumps({"archive": destination, "members": tar_writer.index}).encode(), private_key, public_key))
+    try:
+        sftp.posix_rename(partial, destination)
+    except IOError:
+        # server doesn't support posix-rename, and plain rename doesn't replace existing files
+        if _get_remote_size(sftp, destination) > 0:
+            sftp.remove(destination)
+        sftp.rename(partial, destination)
+    # written last, so that an interrupted upload never has a matching digest
+    with sftp.open(f"{destination}.members.sha256", "wb") as remote_file:
+        remote_file.write(f"{digest}\n".encode())
+    print(f"Finished uploading {destination} with {len(tar_writer.index)} files")
+
+
+def _sftp_upload_bundles(
+    sftp: paramiko.SFTPClient,
+    directory: str = "",
+    private_key: Union[bytes, Path] = b"",
+    public_key: Union[str, Path] = "",
+    overwrite: bool = False,
+    client: str = "",
+    rules: Optional[WalkRules] = None,
+    bundle_size: Optional[int] = None,
+) -> None:
+    """Upload directory as one encrypted tar archive, or as numbered archives of at most `bundle_size` bytes of files."""
+    bundle_walk = _BundleWalk(directory, rules, bundle_size)
+    number = 0
+    while (bundle := bundle_walk.next_bundle()) is not None:
+        count, digest = bundle
+        destination = f"/{bundle_walk.root}.tar.c4gh" if bundle_size is None else f"/{bundle_walk.root}.{number:05d}.tar.c4gh"
+        _upload_bundle(
+            sftp,
+            bundle_walk.members(count),
+            destination,
+            digest,
+            private_key=private_key,
+            public_key=public_key,
+            overwrite=overwrite,
+            client=client,
+        )
+        number += 1
+    stale = f"/{bundle_walk.root}.{number:05d}.tar.c4gh"
+    if bundle_size is not None and _get_remote_size(sftp, stale) > 0:
+        print(f"Warning: {stale} and any later archives are left from an earlier upload of different files")
@@ -7,12 +7,18 @@ import argparse
 from pathlib import Path
 from functools import partial
 
-from typing import Optional, Sequence, Tuple, Union
+from typing import List, Optional, Sequence, Tuple, Union
 
 from crypt4gh.keys import get_private_key, get_public_key
 from nacl.public import PrivateKey
 
-from .sftp import _sftp_connection, _sftp_upload_file, _sftp_upload_directory, _sftp_client
+from .sftp import TransportOptions, _sftp_connection, _sftp_upload_file, _sftp_upload_directory
+from .shard import _parse_hosts, _sftp_clients
+from .bench import bench_ciphers
+from .encrypt import zstandard
+from .bundle import _sftp_upload_bundles
+from .trace import enable_tracing, span, write_trace
+from .walk import WalkRules
 from . import __version__
 
 
@@ -28,16 +34,17 @@ def load_encryption_keys(
 ) -> Tuple:
     """Load encryption keys."""
     private_key = b""
-    if private_key_file:
-        # If using user's own crypt4gh private key
-        try:
-            private_key = get_private_key(private_key_file, partial(mock_callback, private_key_password))
-        except Exception:
-            sys.exit(f"Incorrect password for {private_key_file}")
-    else:
-        # If using generated one-time encryption key
-        private_key = bytes(PrivateKey.generate())
-    public_key = get_public_key(public_key_file)
+    with span("load_encryption_keys"):
+        if private_key_file:
+            # If using user's own crypt4gh private key
+            try:
+                private_key = get_private_key(private_key_file, partial(mock_callback, private_key_password))
+            except Exception:
+                sys.exit(f"Incorrect password for {private_key_file}")
+        else:
+            # If using generated one-time encryption key
+            private_key = bytes(PrivateKey.generate())
+        public_key = get_public_key(public_key_file)
     return private_key, public_key
 
 
@@ -57,8 +64,17 @@ def process_arguments(args: argparse.Namespace) -> argparse.Namespace:
     if not Path(args.public_key).is_file():
         sys.exit(f"Program aborted: Could not find file {args.public_key}")
 
+    # Bundle mode streams the whole directory through one connection as archives
+    if args.bundle:
+        if args.dedup:
+            sys.exit("Program aborted: --bundle can't be used with --dedup.")
+        if len(_parse_hosts(args.hostname or "", args.port)) > 1:
+            sys.exit("Program aborted: --bundle can't be used with several SFTP servers.")
+        if args.compress:
+            sys.exit("Program aborted: --bundle can't be used with --compress.")
+
     # Check for SFTP arguments
-    if args.hostname is None:
+    if args.hostname is None or not _parse_hosts(args.hostname, args.port):
         sys.exit("Program aborted: SFTP server hostname must not be empty.")
     if args.username is None:
         sys.exit("Program aborted: SFTP server username must not be empty.")
@@ -80,6 +96,10 @@ def process_arguments(args: argparse.Namespace) -> argparse.Namespace:
         else:
             sys.exit(f"Program aborted: Could not find file {args.private_key}")
 
+    # zstd compression requires an optional dependency
+    if args.compress == "zstd" and zstandard is None:
+        sys.exit("Program aborted: zstd compression requires the zstandard package, install it with `pip install sda_uploader[zstd]`.")
+
     # User confirmation before uploading
     if args.overwrite:
         user_confirmation = str(input("Existing files and directories will be overwritten, do you want to continue? [y/N] ") or "n").lower()  # nosec
@@ -94,7 +114,11 @@ def parse_arguments(arguments: Union[Sequence, None]) -> argparse.Namespace:
     print("Parsing arguments")
     parser = argparse.ArgumentParser(description="CSC Sensitive Data Submission SFTP Tool.")
     parser.add_argument("target", help="Target file or directory to be uploaded.")
-    parser.add_argument("-host", "--hostname", help="SFTP server hostname.")
+    parser.add_argument(
+        "-host",
+        "--hostname",
+        help="SFTP server hostname. Directory uploads can be spread across several equivalent servers with a comma separated list of host[:port].",
+    )
     parser.add_argument("-p", "--port", default=22, help="SFTP server port number. Defaults to 22.")
     parser.add_argument("-u", "--username", help="SFTP server username.")
     parser.add_argument(
@@ -126,6 +150,52 @@ def parse_arguments(arguments: Union[Sequence, None]) -> argparse.Namespace:
         help="Password for Crypt4GH sender private key. If not set, a password will be prompted if using an existing encryption key.",
     )
     parser.add_argument("-pub", "--public_key", default=None, help="Crypt4GH recipient public key. Required for encryption.")
+    parser.add_argument("--ciphers", default="", help="Comma separated list of preferred SSH ciphers, e.g. aes128-ctr. See `sdacli bench-ciphers`.")
+    parser.add_argument("--macs", default="", help="Comma separated list of preferred SSH MACs, e.g. hmac-sha2-256-etm@openssh.com.")
+    parser.add_argument("--compression", action="store_true", help="Enable SSH compression. Not useful for already encrypted files.")
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=[],
+        help="Only upload files matching this glob pattern, or regular expression if prefixed with 're:'. Can be given multiple times.",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        help="Skip files and directories matching this glob pattern, or regular expression if prefixed with 're:'. Can be given multiple times.",
+    )
+    parser.add_argument("--max_depth", type=int, default=None, help="Do not descend more than this many subdirectories deep. 0 uploads only top-level files.")
+    parser.add_argument("--min_size", type=int, default=None, help="Skip files smaller than this many bytes.")
+    parser.add_argument("--max_size", type=int, default=None, help="Skip files larger than this many bytes.")
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Upload files with identical contents only once, and copy them on the server if it supports copying.",
+    )
+    parser.add_argument("--manifest", default="", help="Write a JSON list of files that were deduplicated with --dedup to this file.")
+    parser.add_argument(
+        "--bundle",
+        action="store_true",
+        help="Upload directory as a streamed encrypted tar archive with an encrypted index of file offsets, instead of file by file.",
+    )
+    parser.add_argument(
+        "--bundle_size",
+        type=int,
+        default=None,
+        help="Split --bundle archives so that each holds at most this many bytes of files. Defaults to a single archive.",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=["gzip", "zstd", "auto"],
+        default="",
+        help="Compress files before encryption, if sampling shows they are compressible. auto uses zstd if it's installed, otherwise gzip.",
+    )
+    parser.add_argument(
+        "--trace",
+        default=None,
+        help="Record timings of upload stages to this file as Chrome trace-event JSON, viewable in chrome://tracing or Perfetto.",
+    )
     parser.add_argument("-v", "--version", action="version", version=__version__, help="Display program version.")
     if len(sys.argv) <= 1:
         # If no command line arguments were given, print help text
@@ -134,32 +204,72 @@ def parse_arguments(arguments: Union[Sequence, None]) -> argparse.Namespace:
     return parser.parse_args(arguments)
 
 
+def _split(value: str) -> List[str]:
+    """Split comma separated command line value."""
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def bench_ciphers_main(arguments: Sequence) -> None:
+    """Benchmark SSH ciphers against a local stand-in server."""
+    parser = argparse.ArgumentParser(prog="sdacli bench-ciphers", description="Measure throughput of SSH ciphers against a local stand-in server.")
+    parser.add_argument("-s", "--size", type=int, default=64, help="Amount of data to send per cipher in MiB. Defaults to 64.")
+    parser.add_argument("--ciphers", default="", help="Comma separated list of ciphers to measure. Defaults to all supported ciphers.")
+    parser.add_argument("--mac", default="", help="MAC to use while measuring. Defaults to the first supported MAC.")
+    args = parser.parse_args(arguments)
+    results = bench_ciphers(size=args.size * 1_048_576, ciphers=_split(args.ciphers), mac=args.mac)
+    if results:
+        print(f"Fastest cipher: {results[0][0]}, use it with --ciphers {results[0][0]}")
+
+
 def main(arguments: Optional[Sequence] = None) -> None:
     """Start program."""
     print("CSC Sensitive Data Submission SFTP Tool")
 
+    if arguments is None:
+        arguments = sys.argv[1:]
+    if len(arguments) > 0 and arguments[0] == "bench-ciphers":
+        bench_ciphers_main(arguments[1:])
+        return
+
     # Get command line arguments
     cli_args = parse_arguments(arguments)
 
     # Process arguments, an error is raised on bad arguments, if no errors, will pass silently
     cli_args = process_arguments(cli_args)
 
+    if cli_args.trace:
+        enable_tracing(cli_args.trace)
+    try:
+        _upload(cli_args)
+    finally:
+        if cli_args.trace:
+            write_trace()
+
+    print("Program finished.")
+
+
+def _upload(cli_args: argparse.Namespace) -> None:
+    """Connect to SFTP server and upload target."""
+    transport_options = TransportOptions(ciphers=_split(cli_args.ciphers), macs=_split(cli_args.macs), compression=cli_args.compression)
+
+    hosts = _parse_hosts(cli_args.hostname, cli_args.port)
+
     # Determine authentication type and test connection
     sftp_auth = _sftp_connection(
         username=cli_args.username,
-        hostname=cli_args.hostname,
-        port=cli_args.port,
+        hostname=hosts[0][0],
+        port=hosts[0][1],
         sftp_key=cli_args.identity_file,
         sftp_pass=cli_args.identity_file_password or cli_args.user_password,
+        transport_options=transport_options,
     )
 
     if not sftp_auth:
         sys.exit("SFTP authentication failed.")
 
-    # Get SFTP client
-    sftp_client = _sftp_client(username=cli_args.username, hostname=cli_args.hostname, port=cli_args.port, sftp_auth=sftp_auth)
-    if sftp_client is None:
-        # This code block will likely never execute and is only to satisfy mypy tests
+    # Get SFTP client for each host
+    sftp_clients = _sftp_clients(username=cli_args.username, hosts=hosts, sftp_auth=sftp_auth, transport_options=transport_options)
+    if not sftp_clients:
         sys.exit("Could not form SFTP client connection.")
 
     # Load Crypt4GH key-files
@@ -169,32 +279,56 @@ def main(arguments: Optional[Sequence] = None) -> None:
         public_key_file=cli_args.public_key,
     )
 
+    rules = WalkRules(
+        include=cli_args.include,
+        exclude=cli_args.exclude,
+        max_depth=cli_args.max_depth,
+        min_size=cli_args.min_size,
+        max_size=cli_args.max_size,
+    )
+
     # Do the upload process
     # If target is a file, handle single file upload case
     if Path(cli_args.target).is_file():
         _sftp_upload_file(
-            sftp=sftp_client,
+            sftp=next(iter(sftp_clients.values())),
             source=cli_args.target,
             destination=Path(cli_args.target).name,
             private_key=private_key,
             public_key=public_key,
             overwrite=cli_args.overwrite,
             client="cli",
+            compression=cli_args.compress,
+        )
+
+    # If target is a directory and bundle mode is set, upload directory as tar archives
+    if Path(cli_args.target).is_dir() and cli_args.bundle:
+        _sftp_upload_bundles(
+            sftp=next(iter(sftp_clients.values())),
+            directory=cli_args.target,
+            private_key=private_key,
+            public_key=public_key,
+            overwrite=cli_args.overwrite,
+            client="cli",
+            rules=rules,
+            bundle_size=cli_args.bundle_size,
         )
 
     # If target is a directory, handle directory upload case
-    if Path(cli_args.target).is_dir():
+    elif Path(cli_args.target).is_dir():
         _sftp_upload_directory(
-            sftp=sftp_client,
+            sftp=sftp_clients,
             directory=cli_args.target,
             private_key=private_key,
             public_key=public_key,
             overwrite=cli_args.overwrite,
             client="cli",
+            rules=rules,
+            dedup=cli_args.dedup,
+            manifest=cli_args.manifest,
+            compression=cli_args.compress,
         )
 
-    print("Program finished.")
-
 
 if __name__ == "__main__":
     main()
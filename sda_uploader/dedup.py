@@ -0,0 +1,183 @@
+"""Find identical files in a directory and place duplicates on the server without uploading them again."""
+
+import os
+import json
+import hashlib
+
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import paramiko
+
+from paramiko.sftp import CMD_EXTENDED, int64
+
+from .encrypt import compression_suffix
+from .sftp import CHUNK_SIZE, _get_remote_size, _is_auto_encrypted_file, _sftp_upload_file, mkdir_p
+from .trace import span
+from .walk import WalkRules, walk_tree
+
+
+def _file_digest(path: str) -> str:
+    """Hash file contents in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def find_duplicates(directory: str, rules: Optional[WalkRules] = None) -> Dict[str, str]:
+    """Return mapping of duplicate file path to the first file with identical contents.
+
+    The tree is walked twice: first only file sizes are counted, then only files
+    sharing their size with another file are hashed.
+    """
+    print("Looking for duplicate files.")
+    sizes: Dict[int, int] = {}
+    for entry, _ in walk_tree(directory, rules):
+        if entry.is_file() and not _is_auto_encrypted_file(entry.path):
+            size = entry.stat().st_size
+            sizes[size] = sizes.get(size, 0) + 1
+    originals: Dict[Tuple[int, str], str] = {}
+    duplicates: Dict[str, str] = {}
+    for entry, _ in walk_tree(directory, rules):
+        if not entry.is_file() or _is_auto_encrypted_file(entry.path):
+            continue
+        size = entry.stat().st_size
+        # empty files are cheaper to upload than to place
+        if size == 0 or sizes.get(size, 0) < 2:
+            continue
+        with span("hash", file=entry.path):
+            key = (size, _file_digest(entry.path))
+        if key in originals:
+            duplicates[entry.path] = originals[key]
+        else:
+            originals[key] = entry.path
+    print(f"Found {len(duplicates)} duplicate file(s).")
+    return duplicates
+
+
+def _remote_path(directory: str, path: str, suffix: str = "") -> str:
+    """Map local file path to the remote path of its encrypted upload, with compression `suffix` such as `.gz`."""
+    relative_path = os.path.relpath(path, directory).replace(os.sep, "/")
+    remote_path = f"/{Path(directory).name}/{relative_path}"
+    return remote_path if remote_path.endswith(".c4gh") else f"{remote_path}{suffix}.c4gh"
+
+
+def _name_taken(path: str, suffix: str) -> bool:
+    """Check if another local file would be uploaded with the name of `path` with compression `suffix`."""
+    return bool(suffix) and (os.path.exists(f"{path}{suffix}") or os.path.exists(f"{path}{suffix}.c4gh"))
+
+
+def _hardlink(sftp: paramiko.SFTPClient, source: str, destination: str) -> None:
+    """Create remote hardlink with the OpenSSH `hardlink@openssh.com` extension."""
+    # paramiko has no public API for these extensions, posix_rename is implemented the same way
+    sftp._request(CMD_EXTENDED, "hardlink@openssh.com", sftp._adjust_cwd(source), sftp._adjust_cwd(destination))  # type: ignore
+
+
+def _copy_data(sftp: paramiko.SFTPClient, source: str, destination: str) -> None:
+    """Copy remote file on the server with the `copy-data` extension."""
+    with sftp.open(source, "rb") as source_file:
+        with sftp.open(destination, "wb") as destination_file:
+            # read length 0 copies until the end of the source file
+            sftp._request(CMD_EXTENDED, "copy-data", source_file.handle, int64(0), int64(0), destination_file.handle, int64(0))  # type: ignore
+
+
+def _is_unsupported(error: IOError) -> bool:
+    """Check if error is the server's `SSH_FX_OP_UNSUPPORTED` status."""
+    # paramiko doesn't keep the status code of other errors than missing files and denied permissions,
+    # only the status message, which servers take from the protocol's description "Operation unsupported"
+    return error.errno is None and "unsupported" in str(error).lower()
+
+
+_PlaceMethods = Dict[str, Callable[[paramiko.SFTPClient, str, str], None]]
+
+
+def _place_duplicate(sftp: paramiko.SFTPClient, source: str, destination: str, methods: _PlaceMethods, overwrite: bool = False) -> str:
+    """Place a copy of an uploaded file on the server, return the method used or empty string if not supported.
+
+    Methods the server doesn't support are removed from `methods`, so they are not tried again.
+    """
+    remote_size = _get_remote_size(sftp, destination)
+    if remote_size > 0:
+        if not overwrite and remote_size == _get_remote_size(sftp, source):
+            return "existing"
+        sftp.remove(destination)
+    for method, place in list(methods.items()):
+        try:
+            with span(method, file=destination):
+                place(sftp, source, destination)
+            return method
+        except IOError as e:
+            print(f"Server side {method} of {source} to {destination} failed: {e}")
+            # other failures, e.g. hardlinks across devices, may only concern this file
+            if _is_unsupported(e):
+                methods.pop(method)
+        # a failed copy can leave an empty file behind
+        if _get_remote_size(sftp, destination) == 0:
+            try:
+                sftp.remove(destination)
+            except IOError:
+                pass
+    return ""
+
+
+def place_duplicates(
+    sftp_for: Callable[[str], paramiko.SFTPClient],
+    directory: str,
+    duplicates: Dict[str, str],
+    private_key: Union[bytes, Path] = b"",
+    public_key: Union[str, Path] = "",
+    overwrite: bool = False,
+    client: str = "",
+    compression: str = "",
+) -> List[Dict[str, str]]:
+    """Place duplicates next to their already uploaded originals, uploading them normally if the server can't copy.
+
+    `sftp_for` returns the client of the server holding a given remote file.
+    A copy gets the compression suffix of its original, as it has the same contents. If another file
+    would be uploaded with that name, the duplicate is uploaded normally instead.
+    Returns manifest entries of the placed files.
+    """
+    manifest = []
+    # methods are shared by all hosts, as they are expected to run the same server software
+    methods: _PlaceMethods = {"hardlink": _hardlink, "copy-data": _copy_data}
+    for path, original in duplicates.items():
+        suffix = compression_suffix(original, compression)
+        source = _remote_path(directory, original, suffix)
+        sftp = sftp_for(source)
+        method = ""
+        if _name_taken(path, suffix):
+            print(f"Name {_remote_path(directory, path, suffix)} is taken by another file, uploading {path}")
+        else:
+            destination = _remote_path(directory, path, suffix)
+            mkdir_p(sftp, os.path.dirname(destination).lstrip("/"))
+            method = _place_duplicate(sftp, source, destination, methods, overwrite)
+            if method:
+                print(f"Placed {path} as a copy of {original} with {method}")
+            else:
+                print(f"Server doesn't support copying files, uploading {path}" if not methods else f"Could not copy {source} on the server, uploading {path}")
+        if not method:
+            # uploaded with its own compression, which may differ from the original's
+            destination = _remote_path(directory, path, compression_suffix(path, compression))
+            mkdir_p(sftp, os.path.dirname(destination).lstrip("/"))
+            _sftp_upload_file(
+                sftp=sftp,
+                source=path,
+                destination=destination,
+                private_key=private_key,
+                public_key=public_key,
+                overwrite=overwrite,
+                client=client,
+                compression=compression,
+            )
+            method = "upload"
+        manifest.append({"path": destination, "original": source, "method": method})
+    return manifest
+
+
+def write_manifest(path: Union[str, Path], manifest: List[Dict[str, str]]) -> None:
+    """Write deduplicated paths to a JSON manifest file."""
+    with open(path, "w") as f:
+        f.write(json.dumps({"deduplicated": manifest}, indent=2))
+    print(f"Deduplication manifest written to {path}")
@@ -1,20 +1,197 @@
 """Encrypt file using crypt4gh."""
 
+import os
+import gzip
+import zlib
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from crypt4gh.lib import encrypt
 
-from typing import Union
+from threading import Lock
+from typing import BinaryIO, Deque, Optional, Protocol, Union
 from pathlib import Path
 
+try:
+    import zstandard
+except ImportError:
+    # zstd compression is optional, install with `pip install sda_uploader[zstd]`
+    zstandard = None  # type: ignore[assignment]
+
+# file name suffix of each compression method
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+# files with these suffixes are already compressed, and are not sampled
+COMPRESSED_SUFFIXES = (".gz", ".bgz", ".bz2", ".xz", ".zst", ".zip", ".7z", ".bam", ".cram", ".bcf", ".png", ".jpg", ".jpeg", ".c4gh")
+# a file is compressed if samples of it compress to less than this ratio of their size
+COMPRESSIBLE_RATIO = 0.8
+SAMPLE_SIZE = 65_536
+# threads used for compressing a file, the gzip pool is shared by all files compressed at the same time
+COMPRESSION_THREADS = int(os.getenv("COMPRESSION_THREADS", str(min(8, os.cpu_count() or 1))))
+GZIP_BLOCK_SIZE = 1_048_576
+# blocks read ahead of the encryption per file, which bounds memory use to a few MiB per file
+GZIP_PREFETCH = 8
+
+_gzip_executor: Optional[ThreadPoolExecutor] = None
+_gzip_executor_lock = Lock()
+
+
+class _Readable(Protocol):
+    """Stream supporting `readinto`."""
+
+    def readinto(self, buffer: memoryview) -> int:
+        """Read into buffer."""
+
+
+class _FullReader:
+    """Reader that fills the whole buffer unless the stream ends.
+
+    Crypt4GH treats a short read as the end of the file, but reads from pipes and compressors can return less than asked.
+    """
+
+    def __init__(self, stream: _Readable) -> None:
+        """Wrap stream."""
+        self.stream = stream
+        # bytes read so far, to check that the whole stream was encrypted
+        self.size = 0
+
+    def readinto(self, buffer: bytearray) -> int:
+        """Read into buffer until it's full or the stream ends."""
+        view = memoryview(buffer)
+        total = 0
+        while total < len(view):
+            read = self.stream.readinto(view[total:])
+            if not read:
+                break
+            total += read
+        self.size += total
+        return total
+
+
+class _ParallelGzipReader:
+    """Compress a file with gzip on several threads, and read the result.
+
+    The file is compressed in independent blocks that are concatenated as gzip members,
+    which gzip tools decompress as a single file. zlib releases the GIL while compressing.
+    """
+
+    def __init__(self, source: BinaryIO, executor: ThreadPoolExecutor) -> None:
+        """Start compressing the first blocks."""
+        self.source = source
+        self.executor = executor
+        self.pending: Deque[Future] = deque()
+        self.buffer = b""
+        self.position = 0
+        for _ in range(GZIP_PREFETCH):
+            self._submit()
+
+    def _submit(self) -> None:
+        """Read next block and start compressing it."""
+        block = self.source.read(GZIP_BLOCK_SIZE)
+        if block:
+            self.pending.append(self.executor.submit(gzip.compress, block, 6))
+
+    def readinto(self, buffer: memoryview) -> int:
+        """Read compressed data into buffer, blocks are returned in file order."""
+        if self.position == len(self.buffer):
+            if not self.pending:
+                return 0
+            self.buffer = self.pending.popleft().result()
+            self.position = 0
+            self._submit()
+        start = self.position
+        end = min(len(self.buffer), start + len(buffer))
+        buffer[: end - start] = self.buffer[start:end]
+        self.position = end
+        return end - start
 
-def encrypt_file(file: Union[str, Path] = "", private_key_file: Union[bytes, Path] = b"", recipient_public_key: Union[str, Path] = "") -> None:
-    """Encrypt a file with Crypt4GH."""
-    print(f"Encrypting {file} as {file}.c4gh")
+
+def _get_gzip_executor() -> ThreadPoolExecutor:
+    """Return the thread pool shared by all gzip compressions."""
+    global _gzip_executor
+    with _gzip_executor_lock:
+        if _gzip_executor is None:
+            _gzip_executor = ThreadPoolExecutor(max_workers=COMPRESSION_THREADS, thread_name_prefix="gzip")
+        return _gzip_executor
+
+
+def _is_crypt4gh(file: Union[str, Path]) -> bool:
+    """Check for Crypt4GH header without logging."""
+    with open(file, "rb") as f:
+        return f.read(8) == b"crypt4gh"
+
+
+def is_compressible(file: Union[str, Path] = "") -> bool:
+    """Check if a file is worth compressing by compressing samples from its start, middle and end."""
+    if str(file).lower().endswith(COMPRESSED_SUFFIXES) or _is_crypt4gh(file):
+        return False
+    size = os.path.getsize(file)
+    if size == 0:
+        return False
+    sampled = 0
+    compressed = 0
+    with open(file, "rb") as f:
+        for offset in sorted({0, max(0, size // 2 - SAMPLE_SIZE // 2), max(0, size - SAMPLE_SIZE)}):
+            f.seek(offset)
+            sample = f.read(SAMPLE_SIZE)
+            sampled += len(sample)
+            compressed += len(zlib.compress(sample, 1))
+    return compressed < COMPRESSIBLE_RATIO * sampled
+
+
+def compression_for(file: Union[str, Path] = "", compression: str = "") -> str:
+    """Choose compression method for a file: `compression` if the file is compressible, otherwise empty string.
+
+    `compression` is one of "gzip", "zstd", "auto" or empty string for no compression.
+    "auto" uses zstd if it's installed and gzip otherwise.
+    A file is not compressed if a file next to it would be uploaded with the same name, e.g. `file.gz` next to `file`.
+    """
+    if not compression:
+        return ""
+    method = compression
+    if compression == "auto":
+        method = "zstd" if zstandard is not None else "gzip"
+    compressed_name = f"{file}{COMPRESSION_SUFFIXES[method]}"
+    if os.path.exists(compressed_name) or os.path.exists(f"{compressed_name}.c4gh"):
+        return ""
+    return method if is_compressible(file) else ""
+
+
+def compression_suffix(file: Union[str, Path] = "", compression: str = "") -> str:
+    """Return file name suffix added by compression, e.g. `.zst`, for a file that will be encrypted."""
+    return COMPRESSION_SUFFIXES.get(compression_for(file, compression), "")
+
+
+def encrypt_file(
+    file: Union[str, Path] = "",
+    private_key_file: Union[bytes, Path] = b"",
+    recipient_public_key: Union[str, Path] = "",
+    compression: str = "",
+) -> str:
+    """Encrypt a file with Crypt4GH, optionally compressing it first with "gzip" or "zstd", and return the name of the encrypted file.
+
+    The encrypted file is named `file.c4gh` also when compressed, so that it can't collide with the
+    encrypted copy of another file, the compression suffix is only added to the uploaded name.
+    """
+    encrypted_name = f"{file}.c4gh"
+    print(f"Encrypting {file} as {encrypted_name}" + (f" with {compression} compression" if compression else ""))
     original_file = open(file, "rb")
-    encrypted_file = open(f"{file}.c4gh", "wb")
-    encrypt([(0, private_key_file, recipient_public_key)], original_file, encrypted_file)
-    original_file.close()
-    encrypted_file.close()
+    encrypted_file = open(encrypted_name, "wb")
+    try:
+        if compression == "zstd":
+            if zstandard is None:
+                raise Exception("zstd compression requires the zstandard package.")
+            zstd_reader = zstandard.ZstdCompressor(level=3, threads=COMPRESSION_THREADS).stream_reader(original_file)
+            encrypt([(0, private_key_file, recipient_public_key)], _FullReader(zstd_reader), encrypted_file)
+        elif compression == "gzip":
+            gzip_reader = _ParallelGzipReader(original_file, _get_gzip_executor())
+            encrypt([(0, private_key_file, recipient_public_key)], _FullReader(gzip_reader), encrypted_file)
+        else:
+            encrypt([(0, private_key_file, recipient_public_key)], original_file, encrypted_file)
+    finally:
+        original_file.close()
+        encrypted_file.close()
     print("Encryption has finished.")
+    return encrypted_name
 
 
 def verify_crypt4gh_header(file: Union[str, Path] = "") -> bool:
@@ -3,8 +3,10 @@
 import os
 import sys
 import json
+import queue
+import threading
 import tkinter as tk
-from typing import Dict, Union
+from typing import Any, Dict, Optional, Tuple, Union
 import paramiko
 
 from tkinter.simpledialog import askstring
@@ -18,9 +20,15 @@ from stat import S_IRWXU
 from crypt4gh.keys import get_public_key
 from nacl.public import PrivateKey
 
-from .sftp import _sftp_connection, _sftp_upload_file, _sftp_upload_directory, _sftp_client
+from .sftp import TransportOptions, _sftp_connection, _sftp_upload_file, _sftp_upload_directory
+from .shard import _parse_hosts, _sftp_clients
 from pathlib import Path
 
+# seconds between SSH keepalive messages, keeps connection open between uploads
+KEEPALIVE_INTERVAL = int(os.getenv("SFTP_KEEPALIVE_INTERVAL", "30"))
+# seconds to wait for a kept connection to respond before it's considered stale
+SESSION_CHECK_TIMEOUT = 5
+
 OS_CONFIG = {"field_width": 40, "config_button_width": 25}
 if system() == "Linux":
     # use default config
@@ -50,11 +58,18 @@ class GUI:
             self.tmp_stdout = open(os.devnull, "w")
             sys.stdout = self.tmp_stdout
         # print to activity log instead of console
+        self.log_queue: queue.Queue = queue.Queue()
         sys.stdout.write = self.print_redirect  # type:ignore
 
         # Load previous values from config file
         self.config_file = Path(Path.home()).joinpath(".sda_uploader_config.json")
         data = self.read_config(self.config_file)
+        # SSH algorithm preferences can only be set in the config file
+        self.transport_options = TransportOptions(
+            ciphers=data.get("ssh_ciphers", []),
+            macs=data.get("ssh_macs", []),
+            compression=bool(data.get("ssh_compression", False)),
+        )
 
         # 1st column FIELDS AND LABELS
 
@@ -159,6 +174,9 @@ class GUI:
         self.remember_pass = tk.BooleanVar()
         self.overwrite_files = tk.BooleanVar()
         self.passwords: Dict[str, Union[str, bool]] = {"sftp_password": "", "asked_password": False}
+        self.session: Dict[str, paramiko.SFTPClient] = {}
+        self.session_key = ("", "", "")
+        self.session_auth: Optional[Union[paramiko.PKey, str]] = None
         self.remember_password = tk.Checkbutton(window, text="Save password for this session", variable=self.remember_pass, onvalue=True, offvalue=False)
         self.overwrite_files_option = tk.Checkbutton(
             window, text="Overwrite existing remote files", variable=self.overwrite_files, onvalue=True, offvalue=False
@@ -168,12 +186,21 @@ class GUI:
 
     def print_redirect(self, message: str) -> None:
         """Print to activity log widget instead of console."""
+        if threading.current_thread() is not threading.main_thread():
+            # tkinter may only be used from the main thread, messages from upload threads are shown by flush_log
+            self.log_queue.put(message)
+            return
         self.activity_field.config(state="normal")
         self.activity_field.insert(tk.END, message, None)  # type: ignore
         self.activity_field.see(tk.END)
         self.activity_field.config(state="disabled")
         self.window.update()
 
+    def flush_log(self) -> None:
+        """Show messages printed by upload threads in activity log widget."""
+        while not self.log_queue.empty():
+            self.print_redirect(self.log_queue.get())
+
     def open_file(self, action: str) -> None:
         """Open file and return result according to type."""
         if action == "public":
@@ -200,56 +227,121 @@ class GUI:
             print(f"Unknown action: {action}")
 
     def _do_upload(self, private_key: bytes) -> None:
-        # Ask for RSA key password
-        sftp_password: str = str(self.passwords["sftp_password"])
-        if not self.passwords["asked_password"]:
-            _prompted_password = askstring("SFTP Passphrase", "Passphrase for SSH KEY or SFTP Username.\nLeave empty if using unencrypted SSH Key.", show="*")
-            if _prompted_password is None:
-                # This if-clause is for closing the prompt without proceeding with the upload workflow
-                return
-            sftp_password = str(_prompted_password)  # must cast to string, because initial type allows None values
-            if self.remember_pass.get():
-                # password is stored only for this session, in case the user wants to upload again
-                self.passwords["sftp_password"] = sftp_password
-            self.passwords["asked_password"] = True
-        # Test SFTP connection
         sftp_username = self.sftp_username_value.get()
-        sftp_hostname, sftp_port = "", 22
-        try:
-            sftp_server = self.sftp_server_value.get().split(":")
-            sftp_hostname = sftp_server[0]
-            sftp_port = int(sftp_server[1])
-        except (ValueError, IndexError):
-            sftp_hostname = self.sftp_server_value.get()
-        sftp_auth = self.test_sftp_connection(
-            username=sftp_username,
-            hostname=sftp_hostname,
-            port=sftp_port,
-            sftp_key=self.sftp_key_value.get(),
-            sftp_pass=sftp_password,
-        )
-        # Encrypt and upload
-        if private_key and sftp_auth:
-            sftp = _sftp_client(
+        # several equivalent servers can be given as a comma separated list
+        sftp_hosts = _parse_hosts(self.sftp_server_value.get(), 22)
+        session_key = (sftp_username, self.sftp_server_value.get(), self.sftp_key_value.get())
+        # Reuse connection from previous upload if the fields haven't changed
+        sftp = self._reuse_session(session_key)
+        if not sftp:
+            # Ask for RSA key password
+            sftp_password: str = str(self.passwords["sftp_password"])
+            if not self.passwords["asked_password"]:
+                _prompted_password = askstring(
+                    "SFTP Passphrase", "Passphrase for SSH KEY or SFTP Username.\nLeave empty if using unencrypted SSH Key.", show="*"
+                )
+                if _prompted_password is None:
+                    # This if-clause is for closing the prompt without proceeding with the upload workflow
+                    return
+                sftp_password = str(_prompted_password)  # must cast to string, because initial type allows None values
+                if self.remember_pass.get():
+                    # password is stored only for this session, in case the user wants to upload again
+                    self.passwords["sftp_password"] = sftp_password
+                self.passwords["asked_password"] = True
+            # Test SFTP connection
+            sftp_hostname, sftp_port = sftp_hosts[0] if sftp_hosts else ("", 22)
+            sftp_auth = self.test_sftp_connection(
                 username=sftp_username,
                 hostname=sftp_hostname,
                 port=sftp_port,
-                sftp_auth=sftp_auth,
+                sftp_key=self.sftp_key_value.get(),
+                sftp_pass=sftp_password,
+            )
+            if sftp_auth:
+                sftp = self._open_session(session_key, sftp_auth)
+        # Encrypt and upload
+        if private_key and sftp:
+            public_key = get_public_key(self.their_key_value.get())
+            self.sftp_upload(
+                sftp=sftp,
+                target=self.file_value.get(),
+                private_key=private_key,
+                public_key=public_key,
+                overwrite=self.overwrite_files.get(),
             )
-            if sftp:
-                # This code block will always execute and is only here to satisfy mypy tests
-                public_key = get_public_key(self.their_key_value.get())
-                self.sftp_upload(
-                    sftp=sftp,
-                    target=self.file_value.get(),
-                    private_key=private_key,
-                    public_key=public_key,
-                    overwrite=self.overwrite_files.get(),
-                )
         else:
             print("Could not form SFTP connection.")
             self.passwords["asked_password"] = False  # resetting prompt in case password was wrong
 
+    def _open_session(self, session_key: Tuple[str, str, str], sftp_auth: Union[paramiko.PKey, str]) -> Dict[str, paramiko.SFTPClient]:
+        """Connect to SFTP servers and keep the connections alive for later uploads."""
+        self.session = _sftp_clients(
+            username=session_key[0],
+            hosts=_parse_hosts(session_key[1], 22),
+            sftp_auth=sftp_auth,
+            transport_options=self.transport_options,
+        )
+        for sftp in self.session.values():
+            sftp.get_channel().get_transport().set_keepalive(KEEPALIVE_INTERVAL)  # type: ignore
+        self.session_key = session_key
+        # authentication is kept in memory only if the user chose to save the password,
+        # so that a stale connection can be reconnected without asking again
+        self.session_auth = sftp_auth if self.remember_pass.get() else None
+        return self.session
+
+    def _reuse_session(self, session_key: Tuple[str, str, str]) -> Dict[str, paramiko.SFTPClient]:
+        """Return connections from previous upload, reconnect them if they have gone stale."""
+        if not self.session or session_key != self.session_key:
+            self.close_session()
+            return {}
+        if all(self._session_alive(sftp) for sftp in self.session.values()):
+            print("Reusing SFTP connection.")
+            return self.session
+        sftp_auth = self.session_auth
+        self.close_session()
+        if sftp_auth is None:
+            print("SFTP connection has gone stale.")
+            # password was not saved, so it's asked again
+            self.passwords["asked_password"] = False
+            return {}
+        print("SFTP connection has gone stale, reconnecting.")
+        return self._open_session(session_key, sftp_auth)
+
+    def _session_alive(self, sftp: paramiko.SFTPClient) -> bool:
+        """Check that SFTP connection still responds."""
+        channel = sftp.get_channel()
+        transport = channel.get_transport()  # type: ignore
+        if transport is None or not transport.is_active():
+            return False
+        # a half-open connection would otherwise block the GUI until TCP gives up
+        timeout = channel.gettimeout()  # type: ignore
+        channel.settimeout(SESSION_CHECK_TIMEOUT)  # type: ignore
+        try:
+            sftp.normalize(".")
+            return True
+        except Exception:
+            # timeout included
+            return False
+        finally:
+            channel.settimeout(timeout)  # type: ignore
+
+    def close_session(self, log: bool = True) -> None:
+        """Close SFTP connections kept open between uploads.
+
+        `log` must be False once the window has been destroyed, as printing writes to the activity log widget.
+        """
+        if self.session:
+            if log:
+                print("Disconnecting SFTP.")
+            for sftp in self.session.values():
+                sftp.close()
+                sftp.get_channel().get_transport().close()  # type: ignore
+            if log:
+                print("SFTP has been disconnected.")
+        self.session = {}
+        self.session_key = ("", "", "")
+        self.session_auth = None
+
     def _start_process(self) -> None:
         if self.their_key_value.get() and self.file_value.get() and self.sftp_username_value.get() and self.sftp_server_value.get():
             # Generate random encryption key
@@ -266,13 +358,16 @@ class GUI:
             "sftp_username": self.sftp_username_value.get(),
             "sftp_server": self.sftp_server_value.get(),
             "sftp_key_file": self.sftp_key_value.get(),
+            "ssh_ciphers": list(self.transport_options.ciphers),
+            "ssh_macs": list(self.transport_options.macs),
+            "ssh_compression": self.transport_options.compression,
         }
         with open(self.config_file, "w") as f:
             f.write(json.dumps(data))
         # Set file to be readable and writable
         chmod(self.config_file, S_IRWXU)
 
-    def read_config(self, path: Union[str, Path]) -> Dict[str, str]:
+    def read_config(self, path: Union[str, Path]) -> Dict[str, Any]:
         """Read field values from previous run if they exist."""
         data = {}
         if Path(path).is_file():
@@ -284,13 +379,20 @@ class GUI:
         self, username: str = "", hostname: str = "", port: int = 22, sftp_key: str = "", sftp_pass: str = ""
     ) -> Union[paramiko.PKey, str, None]:
         """Test SFTP connection and determine key type before uploading."""
-        _sftp_auth = _sftp_connection(username=username, hostname=hostname, port=port, sftp_key=sftp_key, sftp_pass=sftp_pass)
+        _sftp_auth = _sftp_connection(
+            username=username,
+            hostname=hostname,
+            port=port,
+            sftp_key=sftp_key,
+            sftp_pass=sftp_pass,
+            transport_options=self.transport_options,
+        )
         self.write_config()  # save fields
         return _sftp_auth
 
     def sftp_upload(
         self,
-        sftp: paramiko.SFTPClient,
+        sftp: Dict[str, paramiko.SFTPClient],
         target: str = "",
         private_key: Union[bytes, Path] = b"",
         public_key: Union[str, Path] = "",
@@ -301,7 +403,7 @@ class GUI:
 
         if Path(target).is_file():
             _sftp_upload_file(
-                sftp=sftp,
+                sftp=next(iter(sftp.values())),
                 source=target,
                 destination=Path(target).name,
                 private_key=private_key,
@@ -318,15 +420,17 @@ class GUI:
                 public_key=public_key,
                 overwrite=overwrite,
                 client="gui",
+                wait=self.flush_log,
             )
-
-        # Close SFTP connection
-        print("Disconnecting SFTP.")
-        sftp.close()
-        print("SFTP has been disconnected.")
+        self.flush_log()
+        # SFTP connection is kept open for the next upload, and closed in cleanup
 
     def cleanup(self) -> None:
-        """Restore the sys.stdout on Windows."""
-        if system() == "Windows":
-            sys.stdout = self.old_stdout
-            self.tmp_stdout.close()
+        """Close SFTP connections and restore the sys.stdout on Windows."""
+        try:
+            # called after the main loop has ended and the widgets are destroyed
+            self.close_session(log=False)
+        finally:
+            if system() == "Windows":
+                sys.stdout = self.old_stdout
+                self.tmp_stdout.close()
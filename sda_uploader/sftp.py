@@ -2,28 +2,81 @@
 
 import paramiko
 import os
-from .encrypt import encrypt_file, verify_crypt4gh_header
+import time
+from .encrypt import COMPRESSION_SUFFIXES, compression_for, encrypt_file, verify_crypt4gh_header
+from .trace import span
+from .walk import WalkRules, walk_tree
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Union, Optional
+from typing import Callable, Container, Dict, Sequence, Tuple, Union, Optional
 from sys import stdout as s
 
 CHUNK_SIZE = int(os.getenv("SFTP_CHUNK_SIZE", "1_048_576"))
 
 
-def _sftp_connection(username: str = "", hostname: str = "", port: int = 22, sftp_key: str = "", sftp_pass: str = "") -> Union[paramiko.PKey, str, None]:
+@dataclass
+class TransportOptions:
+    """SSH transport algorithm preferences.
+
+    Preferred ciphers and MACs are offered first, followed by the remaining paramiko defaults,
+    so that a connection can still be negotiated with servers that don't support them.
+    """
+
+    ciphers: Sequence[str] = ()
+    macs: Sequence[str] = ()
+    compression: bool = False
+
+
+def _preferred(preferred: Sequence[str], available: Sequence[str], kind: str) -> Tuple[str, ...]:
+    """Order available algorithms so that the preferred ones come first."""
+    for name in preferred:
+        if name not in available:
+            print(f"Ignoring unsupported SSH {kind}: {name}")
+    first = tuple(name for name in preferred if name in available)
+    return first + tuple(name for name in available if name not in first)
+
+
+def _transport(hostname: str = "", port: int = 22, transport_options: Optional[TransportOptions] = None) -> paramiko.Transport:
+    """Create SSH transport with algorithm preferences applied."""
+    transport = paramiko.Transport((hostname, int(port)))
+    if transport_options:
+        _configure_transport(transport, transport_options)
+    return transport
+
+
+def _configure_transport(transport: paramiko.Transport, transport_options: TransportOptions) -> None:
+    """Apply algorithm preferences to a transport that hasn't been started yet."""
+    security_options = transport.get_security_options()
+    if transport_options.ciphers:
+        security_options.ciphers = _preferred(transport_options.ciphers, security_options.ciphers, "cipher")
+    if transport_options.macs:
+        security_options.digests = _preferred(transport_options.macs, security_options.digests, "MAC")
+    transport.use_compression(transport_options.compression)
+
+
+def _sftp_connection(
+    username: str = "",
+    hostname: str = "",
+    port: int = 22,
+    sftp_key: str = "",
+    sftp_pass: str = "",
+    transport_options: Optional[TransportOptions] = None,
+) -> Union[paramiko.PKey, str, None]:
     """Test SFTP connection and determine key type before uploading."""
     print("Testing connection to SFTP server.")
 
     # Test if key is RSA
-    transport = paramiko.Transport((hostname, int(port)))
+    transport = _transport(hostname, port, transport_options)
     paramiko_key: paramiko.PKey
     try:
         print("Testing if SSH key is of type RSA")
-        paramiko_key = paramiko.rsakey.RSAKey.from_private_key_file(sftp_key, password=sftp_pass)
-        transport.connect(
-            username=username,
-            pkey=paramiko_key,
-        )
+        with span("load_key", key_type="rsa", file=sftp_key):
+            paramiko_key = paramiko.rsakey.RSAKey.from_private_key_file(sftp_key, password=sftp_pass)
+        with span("handshake", auth="rsa", hostname=hostname):
+            transport.connect(
+                username=username,
+                pkey=paramiko_key,
+            )
         print("SFTP test connection: OK")
         return paramiko_key
     except Exception as e:
@@ -33,11 +86,13 @@ def _sftp_connection(username: str = "", hostname: str = "", port: int = 22, sft
     # Test if key is ed25519
     try:
         print("Testing if SSH key is of type Ed25519")
-        paramiko_key = paramiko.ed25519key.Ed25519Key(filename=sftp_key, password=sftp_pass)
-        transport.connect(
-            username=username,
-            pkey=paramiko_key,
-        )
+        with span("load_key", key_type="ed25519", file=sftp_key):
+            paramiko_key = paramiko.ed25519key.Ed25519Key(filename=sftp_key, password=sftp_pass)
+        with span("handshake", auth="ed25519", hostname=hostname):
+            transport.connect(
+                username=username,
+                pkey=paramiko_key,
+            )
         print("SFTP test connection: OK")
         return paramiko_key
     except Exception as e:
@@ -47,10 +102,11 @@ def _sftp_connection(username: str = "", hostname: str = "", port: int = 22, sft
     # Test if username+password authentication is used
     try:
         print("Testing if SFTP login passes with username and password")
-        transport.connect(
-            username=username,
-            password=sftp_pass,
-        )
+        with span("handshake", auth="password", hostname=hostname):
+            transport.connect(
+                username=username,
+                password=sftp_pass,
+            )
         print("SFTP test connection: OK")
         return sftp_pass
     except Exception as e:
@@ -68,14 +124,24 @@ def _sftp_upload_file(
     public_key: Union[str, Path] = "",
     overwrite: bool = False,
     client: str = "",
-) -> None:
-    """Upload a single file."""
-    verified = verify_crypt4gh_header(source)
+    compression: str = "",
+) -> Tuple[int, float]:
+    """Upload a single file, return the number of bytes written to the server and the seconds spent writing them.
+
+    Files that are not yet encrypted are compressed with `compression` before encryption, if they are compressible,
+    and uploaded with the compression suffix, e.g. `file.zst.c4gh`.
+    """
+    with span("verify_crypt4gh_header", file=source):
+        verified = verify_crypt4gh_header(source)
     delete_encrypted_file = False
+    suffix = ""
     destination = destination.replace(os.sep, "/")  # sftp inbox used to auto-convert \ to / but doesn't anymore
     if not verified:
         print(f"File {source} was not recognised as a Crypt4GH file, and must be encrypted before uploading.")
-        encrypt_file(file=source, private_key_file=private_key, recipient_public_key=public_key)
+        with span("encrypt_file", file=source):
+            method = compression_for(source, compression)
+            encrypt_file(file=source, private_key_file=private_key, recipient_public_key=public_key, compression=method)
+        suffix = COMPRESSION_SUFFIXES.get(method, "")
         delete_encrypted_file = True
     # The upload has two methods:
     # 1. resume upload = if remote file is smaller than local file, the missing bytes are uploaded (default option)
@@ -84,19 +150,24 @@ def _sftp_upload_file(
     # The resume upload has been adapted from here:
     # https://chromium.googlesource.com/chromiumos/platform/factory/+/refs/heads/stabilize-8249.B/py/lumberjack/uploader_sftp.py
     source = source if source.endswith(".c4gh") else f"{source}.c4gh"
-    destination = destination if destination.endswith(".c4gh") else f"{destination}.c4gh"
+    destination = destination if destination.endswith(".c4gh") else f"{destination}{suffix}.c4gh"
     write_flag = "wb" if overwrite else "ab"
     remote_size = 0 if overwrite else _get_remote_size(sftp, destination)
     local_size = os.path.getsize(source)
     print(f"Uploading {source} to {destination}")
+    written = 0
+    start = time.perf_counter()
     with open(source, "rb") as local_file:
         with sftp.open(destination, write_flag) as remote_file:
             local_file.seek(remote_size)
             while True:
                 read_buffer = local_file.read(CHUNK_SIZE)
-                remote_file.write(read_buffer)
-                remote_file.flush()
+                with span("write", file=destination, size=len(read_buffer)):
+                    remote_file.write(read_buffer)
+                with span("flush", file=destination):
+                    remote_file.flush()
                 remote_size += len(read_buffer)
+                written += len(read_buffer)
                 _progress(
                     filename=destination,
                     remote_size=remote_size,
@@ -105,12 +176,15 @@ def _sftp_upload_file(
                 )
                 if len(read_buffer) == 0 or local_size == remote_size:
                     break
+    seconds = time.perf_counter() - start
     print(f"Finished uploading {source} to {destination}")
     if delete_encrypted_file:
         # Remove encrypted file, if it was encrypted by sda-uploader, but not, if it was already encrypted by the user
         print(f"Removing auto-encrypted file {source}")
-        os.remove(f"{source}")
+        with span("remove", file=source):
+            os.remove(f"{source}")
         print(f"{source} removed")
+    return written, seconds
 
 
 def _get_remote_size(sftp: paramiko.SFTPClient, filepath: str) -> int:
@@ -136,33 +210,101 @@ def _progress(filename: str = "", remote_size: int = 0, local_size: int = 0, cli
 
 
 def _sftp_upload_directory(
-    sftp: paramiko.SFTPClient,
+    sftp: Union[paramiko.SFTPClient, Dict[str, paramiko.SFTPClient]],
     directory: str = "",
     private_key: Union[bytes, Path] = b"",
     public_key: Union[str, Path] = "",
     overwrite: bool = False,
     client: str = "",
+    rules: Optional[WalkRules] = None,
+    wait: Optional[Callable[[], None]] = None,
+    dedup: bool = False,
+    manifest: str = "",
+    compression: str = "",
 ) -> None:
-    """Upload directory."""
-    for item in os.walk(directory):
-        # determine relative directory structure from absolute path
-        # example /home/user/target -> target
-        # example /home/user/target/subfolder -> target/subfolder
-        # example C:\Users\user\target\subfolder -> target/subfolder
-        relative_structure = f"{Path(directory).name}{item[0].removeprefix(directory)}".replace(os.sep, "/")
-        # first create destination directory structure
-        mkdir_p(sftp, relative_structure)
-        # then upload each file per directory
-        for sub_item in item[2]:
-            _sftp_upload_file(
-                sftp=sftp,
-                source=str(Path(item[0]).joinpath(sub_item)),
-                destination=f"/{str(Path(relative_structure).joinpath(sub_item))}",
-                private_key=private_key,
-                public_key=public_key,
-                overwrite=overwrite,
-                client=client,
-            )
+    """Upload directory.
+
+    If `sftp` is a mapping of host names to clients, files are spread across the hosts,
+    and `wait` is called periodically on the calling thread while the upload runs.
+    If `dedup` is set, files with identical contents are uploaded once and copied on the server,
+    copied files are listed in JSON file `manifest` if it's given.
+    Compressible files are compressed with `compression` before encryption.
+    """
+    # imported here, because these modules build on the functions in this module
+    from .dedup import find_duplicates, place_duplicates, write_manifest
+    from .shard import ShardedUpload
+
+    duplicates = find_duplicates(directory, rules) if dedup else {}
+    if isinstance(sftp, dict) and len(sftp) > 1:
+        sharded_upload = ShardedUpload(sftp, private_key=private_key, public_key=public_key, overwrite=overwrite, client=client, compression=compression)
+        sharded_upload.run(directory, rules, wait, skip=duplicates)
+        clients = sftp
+        fallback = next(iter(clients.values()))
+
+        def sftp_for(remote_file: str) -> paramiko.SFTPClient:
+            return clients.get(sharded_upload.uploaded.get(remote_file, ""), fallback)
+
+    else:
+        if isinstance(sftp, dict):
+            sftp = next(iter(sftp.values()))
+        _upload_tree(sftp, directory, private_key, public_key, overwrite, client, rules, skip=duplicates, compression=compression)
+        single_client = sftp
+
+        def sftp_for(remote_file: str) -> paramiko.SFTPClient:
+            return single_client
+
+    if duplicates:
+        placed = place_duplicates(
+            sftp_for, directory, duplicates, private_key=private_key, public_key=public_key, overwrite=overwrite, client=client, compression=compression
+        )
+        if manifest:
+            write_manifest(manifest, placed)
+
+
+def _upload_tree(
+    sftp: paramiko.SFTPClient,
+    directory: str,
+    private_key: Union[bytes, Path],
+    public_key: Union[str, Path],
+    overwrite: bool,
+    client: str,
+    rules: Optional[WalkRules],
+    skip: Container[str] = (),
+    compression: str = "",
+) -> None:
+    """Upload directory through one SFTP client, local files in `skip` are not uploaded."""
+    # determine relative directory structure from absolute path
+    # example /home/user/target -> target
+    # example /home/user/target/subfolder -> target/subfolder
+    # example C:\Users\user\target\subfolder -> target/subfolder
+    root = Path(directory).name
+    # first create destination directory structure
+    mkdir_p(sftp, root)
+    # then create each subdirectory and upload each file as they are walked
+    for entry, relative_path in walk_tree(directory, rules):
+        if entry.is_dir(follow_symlinks=False):
+            mkdir_p(sftp, f"{root}/{relative_path}")
+            continue
+        if _is_auto_encrypted_file(entry.path) or entry.path in skip:
+            continue
+        _sftp_upload_file(
+            sftp=sftp,
+            source=entry.path,
+            destination=f"/{root}/{relative_path}",
+            private_key=private_key,
+            public_key=public_key,
+            overwrite=overwrite,
+            client=client,
+            compression=compression,
+        )
+
+
+def _is_auto_encrypted_file(path: str) -> bool:
+    """Check if file is an encrypted copy made by sda-uploader of a file next to it.
+
+    The directory is walked lazily, so encrypted copies created during the upload can show up in the walk.
+    """
+    return path.endswith(".c4gh") and (not os.path.exists(path) or os.path.isfile(path.removesuffix(".c4gh")))
 
 
 def mkdir_p(sftp: paramiko.SFTPClient, directory: str) -> None:
@@ -183,9 +325,11 @@ def mkdir_p(sftp: paramiko.SFTPClient, directory: str) -> None:
     while len(directories):
         directory = directories.pop()
         try:
-            sftp.stat(directory)
+            with span("stat", directory=directory):
+                sftp.stat(directory)
         except Exception:
-            sftp.mkdir(directory)
+            with span("mkdir", directory=directory):
+                sftp.mkdir(directory)
 
 
 def _sftp_client(
@@ -193,6 +337,7 @@ def _sftp_client(
     hostname: str = "",
     port: int = 22,
     sftp_auth: Optional[Union[paramiko.PKey, str]] = None,
+    transport_options: Optional[TransportOptions] = None,
 ) -> Optional[paramiko.SFTPClient]:
     """SFTP client."""
     sftp_key = None
@@ -203,10 +348,11 @@ def _sftp_client(
         sftp_key = sftp_auth
     try:
         print(f"Connecting to {hostname} as {username}.")
-        transport = paramiko.Transport((hostname, int(port)))
-        transport.connect(username=username, password=sftp_pass, pkey=sftp_key)
+        transport = _transport(hostname, port, transport_options)
+        with span("handshake", hostname=hostname):
+            transport.connect(username=username, password=sftp_pass, pkey=sftp_key)
         sftp = paramiko.SFTPClient.from_transport(transport)
-        print("SFTP connected, ready to upload files.")
+        print(f"SFTP connected using cipher {transport.local_cipher} and MAC {transport.local_mac}, ready to upload files.")
         return sftp
     except paramiko.BadHostKeyException as e:
         print(f"SFTP error: {e}")
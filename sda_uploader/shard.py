@@ -0,0 +1,307 @@
+"""Spread a directory upload across several equivalent SFTP hosts."""
+
+import os
+import queue
+import threading
+import time
+
+from collections import deque
+from pathlib import Path
+from typing import Callable, Container, Deque, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+import paramiko
+
+from .encrypt import compression_suffix
+from .sftp import TransportOptions, _get_remote_size, _is_auto_encrypted_file, _sftp_client, _sftp_upload_file, mkdir_p
+from .walk import WalkRules, walk_tree
+
+# a host is considered slow, and stops taking new files, if its throughput drops below this ratio of the fastest host
+SLOW_HOST_RATIO = float(os.getenv("SFTP_SLOW_HOST_RATIO", "0.25"))
+# throughput is only compared after a host has uploaded at least this many bytes
+SLOW_HOST_MIN_BYTES = 8 * 1_048_576
+
+# (local path, remote path relative to the upload root, is directory)
+_Task = Tuple[str, str, bool]
+
+
+def _parse_hosts(hostnames: str, port: Union[int, str] = 22) -> List[Tuple[str, int]]:
+    """Parse comma separated `host[:port]` list, hosts without port use `port`."""
+    hosts = []
+    for hostname in hostnames.split(","):
+        hostname = hostname.strip()
+        if not hostname:
+            continue
+        try:
+            host, host_port = hostname.rsplit(":", 1)
+            hosts.append((host, int(host_port)))
+        except ValueError:
+            hosts.append((hostname, int(port)))
+    return hosts
+
+
+def _sftp_clients(
+    username: str = "",
+    hosts: Sequence[Tuple[str, int]] = (),
+    sftp_auth: Optional[Union[paramiko.PKey, str]] = None,
+    transport_options: Optional[TransportOptions] = None,
+) -> Dict[str, paramiko.SFTPClient]:
+    """Connect SFTP clients to each host, hosts that can't be connected to are skipped."""
+    clients = {}
+    for hostname, port in hosts:
+        try:
+            sftp = _sftp_client(username=username, hostname=hostname, port=port, sftp_auth=sftp_auth, transport_options=transport_options)
+        except Exception as e:
+            print(f"Skipping SFTP host {hostname}:{port}, error: {e}")
+            continue
+        if sftp is not None:
+            clients[f"{hostname}:{port}"] = sftp
+    return clients
+
+
+class _Host:
+    """Upload state of one SFTP host."""
+
+    def __init__(self, name: str, sftp: paramiko.SFTPClient) -> None:
+        """Initialise host state."""
+        self.name = name
+        self.sftp = sftp
+        self.alive = True
+        self.uploaded_bytes = 0
+        self.upload_seconds = 0.0
+        # files that have a partial copy on this host and must be resumed here
+        self.handoff: Deque[_Task] = deque()
+        # remote directories known to exist on this host
+        self.directories: Set[str] = set()
+        # an SFTP client must only be used by one thread, so other workers check
+        # for partial files through a separate channel on the same connection
+        self._probe: Optional[paramiko.SFTPClient] = None
+        self._probe_lock = threading.Lock()
+
+    def remote_size(self, filepath: str) -> int:
+        """Get remote file size from another worker's thread."""
+        with self._probe_lock:
+            try:
+                if self._probe is None:
+                    self._probe = paramiko.SFTPClient.from_transport(self.sftp.get_channel().get_transport())  # type: ignore
+                return _get_remote_size(self._probe, filepath)  # type: ignore
+            except Exception:
+                # a broken channel is opened again on the next check
+                self._probe = None
+                raise
+
+    def close_probe(self) -> None:
+        """Close the channel used by other workers."""
+        with self._probe_lock:
+            if self._probe is not None:
+                self._probe.close()
+                self._probe = None
+
+    @property
+    def throughput(self) -> float:
+        """Measured upload throughput in bytes per second."""
+        return self.uploaded_bytes / self.upload_seconds if self.upload_seconds else 0.0
+
+
+class ShardedUpload:
+    """Upload a directory with one worker thread per host.
+
+    Workers take files from a shared bounded queue, so faster hosts naturally take
+    more files. A host that fails is retired and its file is given to the others,
+    and a host whose measured throughput falls below `SLOW_HOST_RATIO` of the
+    fastest host stops taking new files while faster hosts are available. When
+    resuming, a file that already has a partial copy on one host is uploaded there.
+    """
+
+    def __init__(
+        self,
+        hosts: Dict[str, paramiko.SFTPClient],
+        private_key: Union[bytes, Path] = b"",
+        public_key: Union[str, Path] = "",
+        overwrite: bool = False,
+        client: str = "",
+        compression: str = "",
+    ) -> None:
+        """Initialise upload."""
+        self.hosts = [_Host(name, sftp) for name, sftp in hosts.items()]
+        self.private_key = private_key
+        self.public_key = public_key
+        self.overwrite = overwrite
+        self.client = client
+        self.compression = compression
+        self.uploaded: Dict[str, str] = {}  # remote file -> host name
+        self.failed: List[str] = []
+        self._queue: queue.Queue = queue.Queue(maxsize=4 * len(self.hosts))
+        self._retry: Deque[_Task] = deque()
+        self._lock = threading.Lock()
+        self._exhausted = False
+        self._in_flight = 0
+
+    def run(
+        self,
+        directory: str,
+        rules: Optional[WalkRules] = None,
+        wait: Optional[Callable[[], None]] = None,
+        skip: Container[str] = (),
+    ) -> None:
+        """Upload `directory`, `wait` is called periodically on the calling thread while workers run.
+
+        Local files in `skip` are not uploaded.
+        """
+        root = Path(directory).name
+        workers = [threading.Thread(target=self._worker, args=(host,), name=f"sftp-{host.name}", daemon=True) for host in self.hosts]
+        for worker in workers:
+            worker.start()
+        try:
+            self._put((directory, root, True), wait)
+            for entry, relative_path in walk_tree(directory, rules):
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if not is_dir and (_is_auto_encrypted_file(entry.path) or entry.path in skip):
+                    continue
+                self._put((entry.path, f"{root}/{relative_path}", is_dir), wait)
+        finally:
+            self._exhausted = True
+        while any(worker.is_alive() for worker in workers):
+            if wait:
+                wait()
+            for worker in workers:
+                worker.join(timeout=0.1)
+        for host in self.hosts:
+            host.close_probe()
+        if not any(host.alive for host in self.hosts):
+            raise Exception("Upload failed on all SFTP hosts.")
+        for host in self.hosts:
+            print(f"{host.name}: uploaded {host.uploaded_bytes} bytes at {host.throughput / 1_048_576:.1f} MiB/s")
+        if self.failed:
+            raise Exception(f"Upload failed for {len(self.failed)} file(s): {', '.join(self.failed)}")
+
+    def _put(self, task: _Task, wait: Optional[Callable[[], None]]) -> None:
+        """Put task to the shared queue without blocking the calling thread indefinitely."""
+        while True:
+            if not any(host.alive for host in self.hosts):
+                raise Exception("Upload failed on all SFTP hosts.")
+            try:
+                self._queue.put(task, timeout=0.1)
+                return
+            except queue.Full:
+                if wait:
+                    wait()
+
+    def _is_slow(self, host: _Host) -> bool:
+        """Check if another alive host is so much faster that this host should not take new files."""
+        if host.uploaded_bytes < SLOW_HOST_MIN_BYTES:
+            return False
+        fastest = max((other.throughput for other in self.hosts if other.alive and other is not host), default=0.0)
+        return host.throughput < SLOW_HOST_RATIO * fastest
+
+    def _next(self, host: _Host) -> Optional[_Task]:
+        """Get the next task for a host, or None when all work is done."""
+        while host.alive:
+            with self._lock:
+                task = self._take(host)
+                if task is not None:
+                    self._in_flight += 1
+                    return task
+                if self._exhausted and self._queue.empty() and not self._retry and not self._in_flight and not any(other.handoff for other in self.hosts):
+                    return None
+            time.sleep(0.05)
+        return None
+
+    def _take(self, host: _Host) -> Optional[_Task]:
+        """Take a task for host, must be called while holding the lock."""
+        if host.handoff:
+            return host.handoff.popleft()
+        # partial copies on retired hosts can no longer be resumed, upload them anywhere
+        for other in self.hosts:
+            if not other.alive and other.handoff:
+                self._retry.extend(other.handoff)
+                other.handoff.clear()
+        if self._is_slow(host):
+            return None
+        if self._retry:
+            return self._retry.popleft()
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            return None
+
+    def _worker(self, host: _Host) -> None:
+        """Upload tasks on one host until all work is done or the host fails."""
+        while True:
+            task = self._next(host)
+            if task is None:
+                return
+            try:
+                self._upload(host, task)
+            except Exception as e:
+                transport = host.sftp.get_channel().get_transport()  # type: ignore
+                if transport is not None and transport.is_active():
+                    # connection is fine, so the error is specific to this file
+                    print(f"Upload of {task[0]} to {host.name} failed, error: {e}")
+                    with self._lock:
+                        self.failed.append(task[0])
+                    continue
+                print(f"SFTP host {host.name} failed, moving its work to other hosts, error: {e}")
+                with self._lock:
+                    host.alive = False
+                    self._retry.append(task)
+                return
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+
+    def _ensure_directory(self, host: _Host, directory: str) -> None:
+        """Create remote directory on host unless it's known to exist."""
+        if directory not in host.directories:
+            mkdir_p(host.sftp, directory)
+            host.directories.add(directory)
+
+    def _remote_file(self, source: str, destination: str) -> str:
+        """Get remote name of the encrypted file."""
+        return destination if destination.endswith(".c4gh") else f"{destination}{compression_suffix(source, self.compression)}.c4gh"
+
+    def _partial_host(self, host: _Host, remote_file: str) -> Optional[_Host]:
+        """Find another alive host holding a partial copy of a file that this host doesn't have."""
+        if _get_remote_size(host.sftp, remote_file) > 0:
+            return None
+        for other in self.hosts:
+            if other is host or not other.alive:
+                continue
+            try:
+                if other.remote_size(remote_file) > 0:
+                    return other
+            except Exception as e:
+                # the other host's own worker retires it if its connection is gone, this file is not at fault
+                print(f"Could not check for a partial copy of {remote_file} on {other.name}, error: {e}")
+        return None
+
+    def _upload(self, host: _Host, task: _Task) -> None:
+        """Upload one file or create one directory on host."""
+        source, destination, is_dir = task
+        if is_dir:
+            self._ensure_directory(host, destination)
+            return
+        destination = f"/{destination}"
+        remote_file = self._remote_file(source, destination)
+        if not self.overwrite and len(self.hosts) > 1:
+            other = self._partial_host(host, remote_file)
+            if other is not None:
+                with self._lock:
+                    other.handoff.append(task)
+                return
+        self._ensure_directory(host, os.path.dirname(destination).lstrip("/"))
+        # only the transfer is timed, and only bytes actually sent are counted, so encryption
+        # and resumed files that were already complete don't distort the throughput
+        written, seconds = _sftp_upload_file(
+            sftp=host.sftp,
+            source=source,
+            destination=destination,
+            private_key=self.private_key,
+            public_key=self.public_key,
+            overwrite=self.overwrite,
+            client=self.client,
+            compression=self.compression,
+        )
+        with self._lock:
+            host.upload_seconds += seconds
+            host.uploaded_bytes += written
+            self.uploaded[remote_file] = host.name
@@ -0,0 +1,95 @@
+"""Record timed spans of upload stages and export them as Chrome trace events."""
+
+import os
+import json
+import time
+import threading
+
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Any, ContextManager, Dict, Iterator, Optional, Set, TextIO, Union
+
+_file: Optional[TextIO] = None
+_path = ""
+_threads: Set[int] = set()
+_lock = threading.Lock()
+_enabled = False
+# a single no-op context manager is shared by all spans when tracing is off
+_DISABLED = nullcontext()
+
+
+def enable_tracing(path: Union[str, Path]) -> None:
+    """Start recording spans to file `path`.
+
+    Events are written as they happen in the JSON array trace format, so memory use doesn't grow with the length of the upload.
+    """
+    global _enabled, _file, _path
+    _file = open(path, "w")
+    _file.write("[\n")
+    _path = str(path)
+    _enabled = True
+
+
+def tracing_enabled() -> bool:
+    """Return True if spans are being recorded."""
+    return _enabled
+
+
+def span(name: str, **args: object) -> ContextManager:
+    """Time the enclosed block as a span named `name`.
+
+    Keyword arguments are stored with the span and shown in the trace viewer.
+    When tracing is off this returns a shared no-op context manager.
+    """
+    if not _enabled:
+        return _DISABLED
+    return _record_span(name, args)
+
+
+def _write_event(event: Dict[str, Any]) -> None:
+    """Write one event to the trace file, must be called while holding the lock."""
+    if _file is not None:
+        _file.write(json.dumps(event) + ",\n")
+
+
+@contextmanager
+def _record_span(name: str, args: Dict[str, object]) -> Iterator[None]:
+    """Record a complete ("X") trace event around the enclosed block."""
+    thread = threading.current_thread()
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter_ns() - start
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": start / 1000,
+            "dur": duration / 1000,
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": {key: str(value) for key, value in args.items()},
+        }
+        with _lock:
+            if thread.ident not in _threads:
+                _threads.add(thread.ident or 0)
+                _write_event({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": thread.ident, "args": {"name": thread.name}})
+            _write_event(event)
+
+
+def write_trace() -> None:
+    """Stop recording spans and finish the trace file.
+
+    The file can be opened in chrome://tracing, Perfetto or speedscope. The closing bracket
+    of the array is optional in the format, so the file is readable even if the upload crashed.
+    """
+    global _enabled, _file
+    with _lock:
+        _enabled = False
+        if _file is None:
+            return
+        # metadata event without a trailing comma closes the array as valid JSON
+        _file.write(json.dumps({"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": "sda-uploader"}}) + "\n]\n")
+        _file.close()
+        _file = None
+    print(f"Trace written to {_path}")
@@ -0,0 +1,80 @@
+"""Lazily walk a directory tree with include and exclude rules."""
+
+import os
+import re
+
+from dataclasses import dataclass
+from fnmatch import fnmatchcase
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+
+@dataclass
+class WalkRules:
+    r"""Rules deciding which entries of a directory tree are uploaded.
+
+    Patterns are shell-style globs matched against both the entry name and its path
+    relative to the walked directory, e.g. `*.tmp` or `work`. Patterns prefixed with
+    `re:` are regular expressions searched in the relative path, e.g. `re:\.bai$`.
+    Include patterns only apply to files, excluded directories are not descended into.
+    """
+
+    include: Sequence[str] = ()
+    exclude: Sequence[str] = ()
+    max_depth: Optional[int] = None
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
+
+
+def _matches(patterns: Sequence[str], name: str, relative_path: str) -> bool:
+    """Return True if any of the patterns match the entry."""
+    for pattern in patterns:
+        if pattern.startswith("re:"):
+            if re.search(pattern.removeprefix("re:"), relative_path):
+                return True
+        elif fnmatchcase(name, pattern) or fnmatchcase(relative_path, pattern):
+            return True
+    return False
+
+
+def walk_tree(directory: str, rules: Optional[WalkRules] = None) -> Iterator[Tuple[os.DirEntry, str]]:
+    """Yield `(entry, relative_path)` for accepted directories and files under `directory`.
+
+    Entries are produced in depth-first pre-order, so a directory is always yielded
+    before its contents. Relative paths use `/` as separator. Only one `os.scandir`
+    iterator per directory level is kept open, so memory use does not grow with the
+    number of entries in the tree.
+    """
+    rules = rules or WalkRules()
+    stack: List[Tuple[Iterator[os.DirEntry], str, int]] = [(os.scandir(directory), "", 0)]
+    try:
+        while stack:
+            iterator, prefix, depth = stack[-1]
+            entry = next(iterator, None)
+            if entry is None:
+                stack.pop()
+                iterator.close()  # type: ignore
+                continue
+            relative_path = f"{prefix}{entry.name}"
+            # name based rules first, these need no system calls
+            if _matches(rules.exclude, entry.name, relative_path):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if rules.max_depth is not None and depth >= rules.max_depth:
+                    continue
+                yield entry, relative_path
+                stack.append((os.scandir(entry.path), f"{relative_path}/", depth + 1))
+                continue
+            if not entry.is_file():
+                continue
+            if rules.include and not _matches(rules.include, entry.name, relative_path):
+                continue
+            if rules.min_size is not None or rules.max_size is not None:
+                size = entry.stat().st_size
+                if rules.min_size is not None and size < rules.min_size:
+                    continue
+                if rules.max_size is not None and size > rules.max_size:
+                    continue
+            yield entry, relative_path
+    finally:
+        for iterator, _, _ in stack:
+            iterator.close()  # type: ignore
@@ -22,4 +22,5 @@ setup(
         "Programming Language :: Python :: 3.11",
     ],
     install_requires=["crypt4gh", "paramiko"],
+    extras_require={"zstd": ["zstandard"]},
 )
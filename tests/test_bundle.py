@@ -0,0 +1,154 @@
+"""Test uploading a directory as encrypted tar archives."""
+
+import io
+import json
+import os
+import tarfile
+import tempfile
+import unittest
+
+from types import SimpleNamespace
+
+from crypt4gh.lib import decrypt
+from nacl.public import PrivateKey
+
+from sda_uploader.bundle import _sftp_upload_bundles
+
+
+class FakeRemoteFile(io.BytesIO):
+    """Remote file kept in memory, stored when closed."""
+
+    def __init__(self, sftp, path, data=b""):
+        """Open file."""
+        super().__init__(data)
+        self.sftp = sftp
+        self.path = path
+
+    def close(self):
+        """Store file contents."""
+        if not self.closed:
+            self.sftp.files[self.path] = self.getvalue()
+        super().close()
+
+
+class FakeSFTP:
+    """SFTP client of a host that keeps files in memory, and counts the files opened for writing."""
+
+    def __init__(self):
+        """Initialise host."""
+        self.files = {}
+        self.written = []
+
+    def stat(self, path):
+        """Stat file."""
+        if path in self.files:
+            return SimpleNamespace(st_size=len(self.files[path]))
+        raise FileNotFoundError(path)
+
+    def open(self, path, mode="r"):
+        """Open file for reading or writing."""
+        if "w" in mode:
+            self.written.append(path)
+            return FakeRemoteFile(self, path)
+        if path not in self.files:
+            raise FileNotFoundError(path)
+        return FakeRemoteFile(self, path, self.files[path])
+
+    def posix_rename(self, source, destination):
+        """Rename file, replacing the destination."""
+        self.files[destination] = self.files.pop(source)
+
+
+class TestUploadBundles(unittest.TestCase):
+    """Test archive contents and resuming of bundle uploads."""
+
+    def setUp(self):
+        """Create a directory of files to upload and encryption keys."""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.directory = os.path.join(self.tmp.name, "data")
+        os.makedirs(os.path.join(self.directory, "sub"))
+        self.contents = {}
+        for number in range(4):
+            name = f"sub/f{number}" if number % 2 else f"f{number}"
+            self.write(name, os.urandom(1000 + number))
+        self.private_key = bytes(PrivateKey.generate())
+        self.recipient = PrivateKey.generate()
+        self.sftp = FakeSFTP()
+
+    def write(self, name, data):
+        """Write a file to upload."""
+        self.contents[f"data/{name}"] = data
+        with open(os.path.join(self.directory, name), "wb") as f:
+            f.write(data)
+
+    def upload(self, bundle_size=None):
+        """Upload the directory as bundles, and return the remote files that were written."""
+        self.sftp.written.clear()
+        _sftp_upload_bundles(
+            self.sftp,
+            self.directory,
+            private_key=self.private_key,
+            public_key=bytes(self.recipient.public_key),
+            bundle_size=bundle_size,
+        )
+        return [path for path in self.sftp.written if path.endswith(".tar.c4gh.part")]
+
+    def decrypt(self, path):
+        """Decrypt a remote file."""
+        output = io.BytesIO()
+        decrypt([(0, bytes(self.recipient), None)], io.BytesIO(self.sftp.files[path]), output)
+        return output.getvalue()
+
+    def member_data(self, archive, member):
+        """Return data of an archive member at the offset given in the index."""
+        start = member["offset_data"]
+        end = start + member["size"]
+        return archive[start:end]
+
+    def test_index_offsets_point_to_file_data(self):
+        """Test that the index gives offsets of the headers and data of each file in the archive."""
+        self.assertEqual(self.upload(), ["/data.tar.c4gh.part"])
+        archive = self.decrypt("/data.tar.c4gh")
+        index = json.loads(self.decrypt("/data.tar.c4gh.index.json.c4gh"))
+        self.assertEqual(index["archive"], "/data.tar.c4gh")
+        self.assertEqual({member["name"] for member in index["members"]}, set(self.contents))
+        for member in index["members"]:
+            self.assertEqual(self.member_data(archive, member), self.contents[member["name"]])
+            # the headers of a member, including any extended headers, start at its offset
+            offset = member["offset"]
+            with tarfile.open(fileobj=io.BytesIO(archive[offset:]), mode="r|") as tar:
+                self.assertEqual(tar.next().name, member["name"])
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            self.assertIn("data/sub", tar.getnames())
+
+    def test_unchanged_bundles_are_skipped(self):
+        """Test that uploading again skips the archives that have already been uploaded."""
+        uploaded = self.upload(bundle_size=1500)
+        self.assertEqual(len(uploaded), 4)
+        self.assertEqual(self.upload(bundle_size=1500), [])
+
+    def test_changed_bundle_is_uploaded_again(self):
+        """Test that only the archive holding a changed file is uploaded again, even if its size stays the same."""
+        self.upload(bundle_size=1500)
+        index = json.loads(self.decrypt("/data.00002.tar.c4gh.index.json.c4gh"))
+        (member,) = index["members"]
+        path = os.path.join(self.tmp.name, member["name"])
+        mtime = os.stat(path).st_mtime_ns
+        self.write(os.path.relpath(path, self.directory), os.urandom(member["size"]))
+        os.utime(path, ns=(mtime + 10**9, mtime + 10**9))
+        self.assertEqual(self.upload(bundle_size=1500), ["/data.00002.tar.c4gh.part"])
+        index = json.loads(self.decrypt("/data.00002.tar.c4gh.index.json.c4gh"))
+        archive = self.decrypt("/data.00002.tar.c4gh")
+        (member,) = index["members"]
+        self.assertEqual(self.member_data(archive, member), self.contents[member["name"]])
+
+    def test_interrupted_bundle_is_uploaded_again(self):
+        """Test that an archive without a digest of its members is not skipped."""
+        self.upload(bundle_size=1500)
+        del self.sftp.files["/data.00001.tar.c4gh.members.sha256"]
+        self.assertEqual(self.upload(bundle_size=1500), ["/data.00001.tar.c4gh.part"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+"""Test placing duplicate files on the server."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from types import SimpleNamespace
+
+from nacl.public import PrivateKey
+
+from sda_uploader.dedup import find_duplicates, place_duplicates
+
+
+class FakeRemoteFile:
+    """Remote file that only keeps its size."""
+
+    def __init__(self, sftp, path):
+        """Open file."""
+        self.sftp = sftp
+        self.path = path
+
+    def __enter__(self):
+        """Enter context."""
+        return self
+
+    def __exit__(self, *args):
+        """Exit context."""
+
+    def write(self, data):
+        """Append data to file."""
+        self.sftp.files[self.path] += len(data)
+
+    def flush(self):
+        """Flush file."""
+
+
+class FakeSFTP:
+    """SFTP client of a host that supports hardlinks, and keeps file sizes in memory."""
+
+    def __init__(self, files):
+        """Initialise host with remote files."""
+        self.files = dict(files)
+        self.links = []
+
+    def stat(self, path):
+        """Stat file."""
+        if path in self.files:
+            return SimpleNamespace(st_size=self.files[path])
+        raise FileNotFoundError(path)
+
+    def open(self, path, mode="r"):
+        """Open file for writing."""
+        self.files.setdefault(path, 0)
+        return FakeRemoteFile(self, path)
+
+    def mkdir(self, path):
+        """Create directory."""
+
+    def _adjust_cwd(self, path):
+        """Return path as is."""
+        return path
+
+    def _request(self, command, extension, source, destination):
+        """Create hardlink."""
+        self.files[destination] = self.files[source]
+        self.links.append((source, destination))
+
+
+class TestPlaceDuplicates(unittest.TestCase):
+    """Test naming of duplicates when files are compressed."""
+
+    def setUp(self):
+        """Create directory with identical compressible files."""
+        self.tmp = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmp, "data")
+        for subdirectory in ("a", "b"):
+            os.makedirs(os.path.join(self.directory, subdirectory))
+            with open(os.path.join(self.directory, subdirectory, "x.vcf"), "w") as f:
+                f.write("chr1\t100\t.\tA\tG\n" * 10000)
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def place(self, original_suffix, sibling=""):
+        """Place duplicates, the original is uploaded with `original_suffix`.
+
+        A file named `sibling` is created next to the original or the duplicate, so that it is not compressed.
+        """
+        duplicates = find_duplicates(self.directory)
+        self.assertEqual(len(duplicates), 1)
+        ((path, original),) = duplicates.items()
+        if sibling:
+            with open(f"{original if sibling == 'original' else path}.gz", "w") as f:
+                f.write("other")
+        original_remote = f"/data/{os.path.relpath(original, self.directory)}{original_suffix}.c4gh"
+        sftp = FakeSFTP({original_remote: 100})
+        private_key = bytes(PrivateKey.generate())
+        public_key = bytes(PrivateKey.generate().public_key)
+        manifest = place_duplicates(lambda remote_file: sftp, self.directory, duplicates, private_key, public_key, compression="gzip")
+        return f"/data/{os.path.relpath(path, self.directory)}", sftp, manifest
+
+    def test_duplicate_gets_suffix_of_original(self):
+        """Test that a duplicate of a compressed original is linked with the same suffix."""
+        remote_path, sftp, manifest = self.place(".gz")
+        self.assertEqual(manifest[0], {"path": f"{remote_path}.gz.c4gh", "original": sftp.links[0][0], "method": "hardlink"})
+
+    def test_uncompressed_original_gives_uncompressed_name(self):
+        """Test that a duplicate of an original that was not compressed is not named as compressed."""
+        remote_path, sftp, manifest = self.place("", sibling="original")
+        self.assertEqual(manifest[0]["path"], f"{remote_path}.c4gh")
+        self.assertEqual(manifest[0]["method"], "hardlink")
+
+    def test_taken_name_is_uploaded(self):
+        """Test that a duplicate is uploaded with its own name if its original's name is taken by another file."""
+        remote_path, sftp, manifest = self.place(".gz", sibling="duplicate")
+        self.assertEqual(manifest[0]["path"], f"{remote_path}.c4gh")
+        self.assertEqual(manifest[0]["method"], "upload")
+        self.assertEqual(sftp.links, [])
+        self.assertIn(f"{remote_path}.c4gh", sftp.files)
+
+
+if __name__ == "__main__":
+    unittest.main()
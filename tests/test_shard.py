@@ -0,0 +1,190 @@
+"""Test spreading directory uploads across several SFTP hosts."""
+
+import os
+import tempfile
+import unittest
+
+from types import SimpleNamespace
+from unittest import mock
+
+from nacl.public import PrivateKey
+from paramiko import SSHException
+
+from sda_uploader.shard import ShardedUpload
+
+
+class FakeTransport:
+    """SSH transport of a fake SFTP host."""
+
+    def __init__(self, sftp):
+        """Initialise transport."""
+        self.sftp = sftp
+        self.active = True
+
+    def is_active(self):
+        """Return True until the connection is lost."""
+        return self.active
+
+
+class FakeRemoteFile:
+    """Remote file kept in memory."""
+
+    def __init__(self, sftp, path):
+        """Open file."""
+        self.sftp = sftp
+        self.path = path
+
+    def __enter__(self):
+        """Enter context."""
+        return self
+
+    def __exit__(self, *args):
+        """Exit context."""
+
+    def write(self, data):
+        """Append data to file."""
+        self.sftp.files[self.path] += data
+
+    def flush(self):
+        """Flush file."""
+
+
+class FakeSFTP:
+    """SFTP client of a host that keeps files in memory.
+
+    If `broken`, the connection is lost when a file is opened. If `failing`, opening files fails but the connection stays up.
+    If `probe_broken`, other workers can't open a channel to the host.
+    """
+
+    def __init__(self, broken=False, failing=False, probe_broken=False):
+        """Initialise host."""
+        self.files = {}
+        self.directories = set()
+        self.broken = broken
+        self.failing = failing
+        self.probe_broken = probe_broken
+        self.transport = FakeTransport(self)
+
+    def stat(self, path):
+        """Stat file or directory."""
+        if path in self.files:
+            return SimpleNamespace(st_size=len(self.files[path]))
+        if path in self.directories:
+            return SimpleNamespace(st_size=0)
+        raise FileNotFoundError(path)
+
+    def mkdir(self, path):
+        """Create directory."""
+        self.directories.add(path)
+
+    def open(self, path, mode="r"):
+        """Open file for writing."""
+        if self.broken:
+            self.transport.active = False
+            raise EOFError("connection lost")
+        if self.failing:
+            raise PermissionError(path)
+        if mode == "wb" or path not in self.files:
+            self.files[path] = bytearray()
+        return FakeRemoteFile(self, path)
+
+    def get_channel(self):
+        """Return channel of the connection."""
+        return SimpleNamespace(get_transport=lambda: self.transport)
+
+    def close(self):
+        """Close client."""
+
+
+class TestShardedUpload(unittest.TestCase):
+    """Test scheduling files between hosts."""
+
+    def setUp(self):
+        """Create a directory of files to upload and encryption keys."""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmp.name, "data")
+        os.mkdir(self.directory)
+        for number in range(6):
+            with open(os.path.join(self.directory, f"f{number}"), "wb") as f:
+                f.write(os.urandom(1000))
+        self.private_key = bytes(PrivateKey.generate())
+        self.public_key = bytes(PrivateKey.generate().public_key)
+        # workers check other hosts for partial files through a probe client on the same connection
+        probe = mock.patch("paramiko.SFTPClient.from_transport", side_effect=self.open_probe)
+        probe.start()
+        self.addCleanup(probe.stop)
+        self.addCleanup(self.tmp.cleanup)
+
+    def open_probe(self, transport):
+        """Open probe client of a fake host."""
+        if transport.sftp.probe_broken:
+            raise SSHException("SSH session not active")
+        return transport.sftp
+
+    def upload(self, hosts):
+        """Upload the directory to hosts."""
+        upload = ShardedUpload(hosts, private_key=self.private_key, public_key=self.public_key)
+        upload.run(self.directory)
+        return upload
+
+    def test_files_are_uploaded_once(self):
+        """Test that each file is uploaded to exactly one host."""
+        hosts = {"a:22": FakeSFTP(), "b:22": FakeSFTP()}
+        upload = self.upload(hosts)
+        expected = {f"/data/f{number}.c4gh" for number in range(6)}
+        self.assertEqual(set(upload.uploaded), expected)
+        for remote_file, name in upload.uploaded.items():
+            self.assertIn(remote_file, hosts[name].files)
+        self.assertEqual(sum(len(sftp.files) for sftp in hosts.values()), 6)
+
+    def test_failed_host_work_moves_to_other_host(self):
+        """Test that files of a host whose connection is lost are uploaded to the remaining host."""
+        hosts = {"a:22": FakeSFTP(broken=True), "b:22": FakeSFTP()}
+        upload = self.upload(hosts)
+        self.assertEqual(len(hosts["b:22"].files), 6)
+        self.assertEqual(set(upload.uploaded.values()), {"b:22"})
+
+    def test_all_hosts_failing_raises(self):
+        """Test that the upload fails when no host is left."""
+        hosts = {"a:22": FakeSFTP(broken=True), "b:22": FakeSFTP(broken=True)}
+        with self.assertRaisesRegex(Exception, "all SFTP hosts"):
+            self.upload(hosts)
+
+    def test_file_error_does_not_retire_host(self):
+        """Test that an error with a working connection fails the file, not the host."""
+        hosts = {"a:22": FakeSFTP(failing=True), "b:22": FakeSFTP(failing=True)}
+        with self.assertRaisesRegex(Exception, "failed for 6 file"):
+            self.upload(hosts)
+
+    def test_partial_file_is_resumed_on_its_host(self):
+        """Test that a file partially uploaded to one host is handed off to that host."""
+        hosts = {"a:22": FakeSFTP(), "b:22": FakeSFTP()}
+        hosts["b:22"].files["/data/f0.c4gh"] = bytearray(b"crypt4gh")
+        upload = self.upload(hosts)
+        self.assertEqual(upload.uploaded["/data/f0.c4gh"], "b:22")
+        self.assertNotIn("/data/f0.c4gh", hosts["a:22"].files)
+        self.assertGreater(len(hosts["b:22"].files["/data/f0.c4gh"]), 8)
+
+    def test_broken_probe_does_not_fail_file(self):
+        """Test that failing to check another host for a partial copy doesn't fail the file."""
+        hosts = {"a:22": FakeSFTP(), "b:22": FakeSFTP(probe_broken=True)}
+        upload = ShardedUpload(hosts, private_key=self.private_key, public_key=self.public_key)
+        upload._upload(upload.hosts[0], (os.path.join(self.directory, "f0"), "data/f0", False))
+        self.assertEqual(upload.uploaded["/data/f0.c4gh"], "a:22")
+        self.assertEqual(upload.failed, [])
+
+    def test_complete_file_is_not_counted_in_throughput(self):
+        """Test that resuming a file that is already complete counts no uploaded bytes."""
+        source = os.path.join(self.directory, "f0.c4gh")
+        with open(source, "wb") as f:
+            f.write(b"crypt4gh" + os.urandom(1000))
+        sftp = FakeSFTP()
+        with open(source, "rb") as f:
+            sftp.files["/data/f0.c4gh"] = bytearray(f.read())
+        upload = ShardedUpload({"a:22": sftp}, private_key=self.private_key, public_key=self.public_key)
+        upload._upload(upload.hosts[0], (source, "data/f0.c4gh", False))
+        self.assertEqual(upload.hosts[0].uploaded_bytes, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()